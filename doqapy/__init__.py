@@ -23,11 +23,22 @@ is planned.
 from __future__ import print_function
 
 import six
+import contextlib
 import datetime
+import json
 import uuid
-import dateutil.parser
 from collections import OrderedDict
 
+from .codec import (
+    encode_list,
+    decode_list,
+    decode_text_list,
+    decode_datetime,
+    decode_date,
+    decode_time,
+)
+from .stats import clock
+
 text_field_type = (six.text_type, None)
 int_field_type = (int, None)
 float_field_type = (float, None)
@@ -71,13 +82,65 @@ undefined = type('undefined',(),{})
 
 class DoqapyDatabase(object):
     _yaml_to_python = {
-        _field_type_to_string[datetime_field_type]: lambda x: dateutil.parser.parse(x),
-        _field_type_to_string[date_field_type]: lambda x: dateutil.parser.parse(x).date(),
-        _field_type_to_string[time_field_type]: lambda x: dateutil.parser.parse(x).time(),
-        _field_type_to_string[list_datetime_field_type]: lambda x: (None if x is None else [dateutil.parser.parse(i) for i in x.split('\t')]),
-        _field_type_to_string[list_date_field_type]: lambda x: (None if x is None else [dateutil.parser.parse(i).date() for i in x.split('\t')]),
-        _field_type_to_string[list_time_field_type]: lambda x: (None if x is None else [dateutil.parser.parse(i).time() for i in x.split('\t')]),
+        _field_type_to_string[datetime_field_type]: lambda x: (None if x is None else decode_datetime(x)),
+        _field_type_to_string[date_field_type]: lambda x: (None if x is None else decode_date(x)),
+        _field_type_to_string[time_field_type]: lambda x: (None if x is None else decode_time(x)),
+        _field_type_to_string[list_text_field_type]: lambda x: (None if x is None else decode_list(x)),
+        _field_type_to_string[list_int_field_type]: lambda x: (None if x is None else decode_list(x)),
+        _field_type_to_string[list_float_field_type]: lambda x: (None if x is None else decode_list(x)),
+        _field_type_to_string[list_bool_field_type]: lambda x: (None if x is None else decode_list(x)),
+        _field_type_to_string[list_datetime_field_type]: lambda x: (None if x is None else [decode_datetime(i) for i in decode_text_list(x)]),
+        _field_type_to_string[list_date_field_type]: lambda x: (None if x is None else [decode_date(i) for i in decode_text_list(x)]),
+        _field_type_to_string[list_time_field_type]: lambda x: (None if x is None else [decode_time(i) for i in decode_text_list(x)]),
+        _field_type_to_string[list_ref_field_type]: lambda x: (None if x is None else decode_list(x)),
+    }
+    _python_to_yaml = {
+        _field_type_to_string[datetime_field_type]: lambda x: x.isoformat(),
+        _field_type_to_string[date_field_type]: lambda x: x.isoformat(),
+        _field_type_to_string[time_field_type]: lambda x: x.isoformat(),
+        _field_type_to_string[list_text_field_type]: encode_list,
+        _field_type_to_string[list_int_field_type]: encode_list,
+        _field_type_to_string[list_float_field_type]: encode_list,
+        _field_type_to_string[list_bool_field_type]: encode_list,
+        _field_type_to_string[list_datetime_field_type]: lambda x: encode_list([i.isoformat() for i in x]),
+        _field_type_to_string[list_date_field_type]: lambda x: encode_list([i.isoformat() for i in x]),
+        _field_type_to_string[list_time_field_type]: lambda x: encode_list([i.isoformat() for i in x]),
+        _field_type_to_string[list_ref_field_type]: encode_list,
+    }
+    # In JSON dumps, lists are JSON arrays and temporal values are
+    # given with isoformat().
+    _python_to_json = {
+        _field_type_to_string[datetime_field_type]: lambda x: x.isoformat(),
+        _field_type_to_string[date_field_type]: lambda x: x.isoformat(),
+        _field_type_to_string[time_field_type]: lambda x: x.isoformat(),
+        _field_type_to_string[list_datetime_field_type]: lambda x: [i.isoformat() for i in x],
+        _field_type_to_string[list_date_field_type]: lambda x: [i.isoformat() for i in x],
+        _field_type_to_string[list_time_field_type]: lambda x: [i.isoformat() for i in x],
     }
+    _json_to_python = {
+        _field_type_to_string[datetime_field_type]: lambda x: (None if x is None else decode_datetime(x)),
+        _field_type_to_string[date_field_type]: lambda x: (None if x is None else decode_date(x)),
+        _field_type_to_string[time_field_type]: lambda x: (None if x is None else decode_time(x)),
+        _field_type_to_string[list_datetime_field_type]: lambda x: (None if x is None else [decode_datetime(i) for i in x]),
+        _field_type_to_string[list_date_field_type]: lambda x: (None if x is None else [decode_date(i) for i in x]),
+        _field_type_to_string[list_time_field_type]: lambda x: (None if x is None else [decode_time(i) for i in x]),
+    }
+
+    # Callables receiving instrumentation events (see doqapy.stats)
+    listeners = ()
+
+    def add_listener(self, listener):
+        '''Add a callable that will be called with the events emitted by
+        instrumented operations (see doqapy.stats).
+        '''
+        self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener):
+        self.listeners = tuple(i for i in self.listeners if i is not listener)
+
+    def _emit(self, event):
+        for listener in self.listeners:
+            listener(event)
 
     def store_document(self, document, collection=None, id=None):
         """Store a document in a collection and returns its reference
@@ -87,6 +150,112 @@ class DoqapyDatabase(object):
         the identifier of the document (also stored in the "_id" field
         of the document).
         """
+        if self.listeners:
+            start = clock()
+        collection, id = self._document_location(document, collection, id)
+        collection_impl = self._prepare_collection(collection, (document,))
+        ref = '%s/%s' % (collection, id)
+        collection_impl._store_document(document, id, ref)
+        if self.listeners:
+            self._emit({'type': 'store', 'time': clock() - start, 'documents': 1})
+        return ref
+
+    def store_documents(self, documents, collection=None, batch_size=1000):
+        """Store all the documents of an iterable and returns the list of
+        their references. Documents are processed by batches of
+        batch_size documents : for each batch, all the missing fields
+        are created at once and documents are inserted together by the
+        backend. Collection and identifiers are chosen as in
+        store_document().
+        """
+        refs = []
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                refs.extend(self._store_batch(batch, collection))
+                batch = []
+        if batch:
+            refs.extend(self._store_batch(batch, collection))
+        return refs
+
+    @contextlib.contextmanager
+    def bulk_load(self, drop_indices=False):
+        '''Context manager to use when storing a large number of
+        documents. Index creations (including those of new collections
+        and fields) are postponed until the end of the context where all
+        indices are built at once. If drop_indices is True, existing
+        indices are also dropped at the beginning and rebuilt at the end.
+        Pending indices are recorded in the database ; if the bulk load
+        is interrupted (e.g. by an exception) they are not built but they
+        are still reported by indices() and can be created later by
+        build_pending_indices() (or at the end of another bulk load).
+        Documents are committed at the end of the context. If an
+        exception is raised in the context, changes that had not been
+        committed are rolled back.
+        '''
+        self._begin_bulk_load(drop_indices)
+        try:
+            yield self
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        finally:
+            self._end_bulk_load()
+        self.build_pending_indices()
+
+    def _begin_bulk_load(self, drop_indices):
+        pass
+
+    def _end_bulk_load(self):
+        pass
+
+    def build_pending_indices(self):
+        '''Create the indices whose creation had been postponed by
+        bulk_load().
+        '''
+        pass
+
+    def writer(self, **kwargs):
+        '''Return a doqapy.writer.DoqapyWriter storing documents of
+        concurrent producers in this database from a background thread.
+        Parameters are passed to DoqapyWriter.
+        '''
+        from doqapy.writer import DoqapyWriter
+        return DoqapyWriter(self, **kwargs)
+
+    def _store_batch(self, documents, collection):
+        located = []
+        for document in documents:
+            document_collection, id = self._document_location(document, collection, None)
+            located.append((document, document_collection, id))
+        return self._store_located(located)
+
+    def _store_located(self, located):
+        '''Store a list of (document, collection, id) and return the list
+        of their references.
+        '''
+        if self.listeners:
+            start = clock()
+        by_collection = OrderedDict()
+        refs = []
+        for document, document_collection, id in located:
+            ref = '%s/%s' % (document_collection, id)
+            by_collection.setdefault(document_collection, []).append((document, id, ref))
+            refs.append(ref)
+        for document_collection, items in six.iteritems(by_collection):
+            collection_impl = self._prepare_collection(document_collection,
+                                                       [i[0] for i in items])
+            collection_impl._store_documents(items)
+        if self.listeners:
+            self._emit({'type': 'store', 'time': clock() - start, 'documents': len(refs)})
+        return refs
+
+    def _document_location(self, document, collection, id):
+        '''Return the (collection, id) pair identifying where a document
+        must be stored.
+        '''
         if collection is None:
             ref = document.get('_ref')
             if ref is None:
@@ -98,6 +267,12 @@ class DoqapyDatabase(object):
             id = document.get('_id')
             if id is None:
                 id = str(uuid.uuid4())
+        return collection, id
+
+    def _prepare_collection(self, collection, documents):
+        '''Return the implementation of a collection after having created
+        it (if necessary) as well as all the fields used in documents.
+        '''
         collection_impl = self.get_collection(collection, None)
         if collection_impl is None:
             collection_impl = self.create_collection(collection)
@@ -109,17 +284,25 @@ class DoqapyDatabase(object):
         if '_ref' not in fields:
             collection_impl.create_field('_ref', text_field_type)
             collection_impl.create_index('_ref')
-    
-        for k, v in six.iteritems(document):
-            if k not in fields:
+
+        new_fields = OrderedDict()
+        errors = {}
+        for document in documents:
+            for k, v in six.iteritems(document):
+                if k in fields or k in new_fields:
+                    continue
                 try:
-                    field_type = collection_impl.field_type_from_value(v)
+                    new_fields[k] = collection_impl.field_type_from_value(v)
                 except TypeError as e:
-                    raise TypeError('In value for "%s": %s' % (k, six.text_type(e)))
-                fields = collection_impl.create_field(k, field_type)
-        ref = '%s/%s' % (collection, id)
-        collection_impl._store_document(document, id, ref)
-        return ref
+                    # Another document may give a value allowing to
+                    # guess the field type (e.g. a non empty list)
+                    errors.setdefault(k, e)
+        for k, e in six.iteritems(errors):
+            if k not in new_fields:
+                raise TypeError('In value for "%s": %s' % (k, six.text_type(e)))
+        for k, field_type in six.iteritems(new_fields):
+            fields = collection_impl.create_field(k, field_type)
+        return collection_impl
         
     def get_collection(self, collection, default=undefined):
         '''Return the collection with the given name or None if it does 
@@ -186,60 +369,130 @@ class DoqapyDatabase(object):
         collection_impl = self.get_collection(collection)
         return collection_impl.documents()
     
+    def traverse(self, start_ref, via, depth=None, direction='forward'):
+        '''Return the documents reachable from the document whose
+        reference is start_ref by following reference fields. via is a
+        list of ref or list_ref field names, either "<collection>.<field>"
+        or "<field>" for the field in all collections having it. With
+        "forward" direction, a document leads to the documents it
+        references; with "backward" direction, it leads to the documents
+        referencing it; "both" follows references in both directions. A
+        document is never visited twice on the same path, and depth
+        (if not None) is the maximum number of references followed.
+        Return a list of (ref, depth) pairs (the start document excluded)
+        where depth is the length of the shortest path, sorted by depth.
+        '''
+        raise NotImplementedError()
+    
     def drop_database(self):
         '''Completely clear a database erasing both its schema and the
         documents.'''
         raise NotImplementedError()
     
-    def yaml_dump(self, file):
-        # Avoid mandatory dependency on yaml for those
-        # who do not call this function
-        import yaml
+    def _dump_schema(self):
         ignore_fields = set(('_id', '_ref'))
-        print('# Schema\n---', file=file)
         schema = {}
         for collection in self.collections():
-            collection_dict = schema[collection] = {
+            schema[collection] = {
                 'fields': dict((k,v) for k, v in six.iteritems(self.fields(collection)) if k not in ignore_fields),
                 'indices': [i for i in self.indices(collection) if i not in ignore_fields],
             }
-        yaml.safe_dump(schema, file, default_flow_style=False)
-        
-        print('\n# Documents', file=file)
+        return schema
+
+    def _dump_documents(self, converters):
+        """Iterates over all the documents of the database (without
+        their "_id" field) after having converted their values with the
+        functions of the converters dictionary (indexed by field type
+        name).
+        """
+        identity = lambda x: x
         for collection in self.collections():
+            fields = self.fields(collection)
+            encoders = dict((k, converters.get(v, identity)) for k, v in six.iteritems(fields))
             for document in self.documents(collection):
-                print('---', file=file)
-                document.pop('_id')
-                yaml.safe_dump(document, file, default_flow_style=False)
+                yield dict((k, encoders[k](v)) for k, v in six.iteritems(document) if k != '_id')
+
+    def _restore(self, schema, documents, converters, batch_size):
+        """Replace the content of the database by the given schema and
+        documents. Values of documents are converted with the functions
+        of the converters dictionary (indexed by field type name).
+        Documents are stored by batches of batch_size in a bulk load,
+        therefore indices are created once all the documents are stored.
+        """
+        self.drop_database()
+        identity = lambda x: x
+        decoders = {}
+        with self.bulk_load():
+            for collection, collection_def in six.iteritems(schema):
+                collection_impl = self.create_collection(collection)
+                for field_name, field_type in six.iteritems(collection_def['fields']):
+                    collection_impl.create_field(field_name, _string_to_field_type[field_type])
+                for field_name in collection_def.get('indices',[]):
+                    collection_impl.create_index(field_name)
+                decoders[collection] = dict((k, converters.get(v, identity))
+                                            for k, v in six.iteritems(self.fields(collection)))
+            self.commit()
 
-    def yaml_restore(self, file):
+            batch = []
+            for document in documents:
+                collection, id = self._document_location(document, None, None)
+                collection_decoders = decoders[collection]
+                document = dict((k, collection_decoders[k](v)) for k, v in six.iteritems(document))
+                batch.append((document, collection, id))
+                if len(batch) >= batch_size:
+                    self._store_located(batch)
+                    self.commit()
+                    batch = []
+            if batch:
+                self._store_located(batch)
+
+    def yaml_dump(self, file):
         # Avoid mandatory dependency on yaml for those
         # who do not call this function
         import yaml
+        print('# Schema\n---', file=file)
+        yaml.safe_dump(self._dump_schema(), file, default_flow_style=False)
         
-        reader = yaml.load_all(file)
+        print('\n# Documents', file=file)
+        for document in self._dump_documents(self._python_to_yaml):
+            print('---', file=file)
+            yaml.safe_dump(document, file, default_flow_style=False)
+
+    def yaml_restore(self, file, batch_size=1000):
+        # Avoid mandatory dependency on yaml for those
+        # who do not call this function
+        import yaml
         
-        # Restore schema
+        reader = yaml.load_all(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
         schema = six.next(reader)
-        self.drop_database()
-        for collection, collection_def in six.iteritems(schema):
-            collection_impl = self.create_collection(collection)
-            for field_name, field_type in six.iteritems(collection_def['fields']):
-                collection_impl.create_field(field_name, _string_to_field_type[field_type])
-            for field_name in collection_def.get('indices',[]):
-                collection_impl.create_index(field_name)
-        self.commit()
-
-        # Restore documents
-        count = 0
-        for document in reader:
-            fields = self.fields(document['_ref'][:document['_ref'].rfind('/')])
-            new_doc = dict((k,self._yaml_to_python.get(fields[k],lambda x:x)(v)) for k, v in six.iteritems(document))
-            self.store_document(new_doc)
-            count += 1
-            if count % 500:
-                self.commit()
-        self.commit()
+        self._restore(schema, reader, self._yaml_to_python, batch_size)
+
+    def jsonl_dump(self, file):
+        """Write the whole database in a text file using JSON Lines
+        format. The first line contains the database schema and each
+        following line contains a document. Documents are read and
+        written one at a time.
+        """
+        dumps = json.JSONEncoder(separators=(',', ':')).encode
+        file.write(dumps({'doqapy_dump': 1, 'schema': self._dump_schema()}))
+        file.write('\n')
+        for document in self._dump_documents(self._python_to_json):
+            file.write(dumps(document))
+            file.write('\n')
+
+    def jsonl_restore(self, file, batch_size=10000):
+        """Replace the content of the database by the content of a file
+        written by jsonl_dump(). Documents are stored by batches of
+        batch_size documents (one transaction per batch) and indices
+        are created at the end. Memory usage does not depend on the size
+        of the file.
+        """
+        loads = json.JSONDecoder().decode
+        lines = (line for line in file if line.strip())
+        header = loads(six.next(lines))
+        if 'doqapy_dump' not in header:
+            raise ValueError('File does not contain a Doqapy dump')
+        self._restore(header['schema'], six.moves.map(loads, lines), self._json_to_python, batch_size)
         
 
 class DoqapyCollection(object):
@@ -340,6 +593,15 @@ class DoqapyCollection(object):
         '''
         raise NotImplementedError()
 
+    def _store_documents(self, documents):
+        '''Store several documents given as a sequence of (document, id,
+        ref). All the necessary fields must have been created when this
+        method is called. Backends should override this method to insert
+        all the documents at once.
+        '''
+        for document, id, ref in documents:
+            self._store_document(document, id, ref)
+
     def indices(self):
         '''Return a list of all fields that have an index.
         '''
@@ -352,19 +614,24 @@ class DoqapyCollection(object):
 
        
         
-def connect(url):
+def connect(url, **kwargs):
     '''
     Create a Doqapy database connection according to the given URL. The
     URL has the following form : <backend>:<database> where
     <backend> identify the type of database that is used and <database>
     is a backend specific value containing database connection information.
+    Keyword arguments are passed to the backend database constructor.
     <backend> can be one of the following:
     sqlite : A SQLite implementation. All Doqapy insertions and queries
              are converted to SQL and used with a SQLite database. <storage>
              must be a valid value for a SQLite connection (e.g. a file name
-             or ':memory:').
+             or ':memory:'). It can be followed by options given as URL
+             query parameters (e.g. 'sqlite:/tmp/db.sqlite?pool=8&wal=1').
+             See DoqapySqliteDatabase for the available options.
     '''
     backend, storage = url.split(':', 1)
     if backend == 'sqlite':
-        from .backends.sqlite.api import DoqapySqliteDatabase
-        return DoqapySqliteDatabase(storage)
+        from .backends.sqlite.api import DoqapySqliteDatabase, parse_url_options
+        storage, options = parse_url_options(storage)
+        options.update(kwargs)
+        return DoqapySqliteDatabase(storage, **options)
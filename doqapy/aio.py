@@ -0,0 +1,132 @@
+'''
+asyncio API for Doqapy databases (requires Python 3.6 or later).
+
+AsyncDoqapyDatabase wraps a DoqapyDatabase and runs its blocking
+methods in threads. Modifications are serialized in a single thread
+since a database has a single writer connection. Queries are run in a
+pool of threads if the database has a pool of read connections (see
+DoqapySqliteDatabase) and in the writer thread otherwise.
+'''
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDoqapyDatabase(object):
+    '''
+    Awaitable facade of a DoqapyDatabase. Parameters are:
+      db: the DoqapyDatabase to use.
+      max_workers: maximum number of threads used to run queries
+                   concurrently when db has a connection pool.
+      max_pending: maximum number of operations submitted to threads.
+                   Other operations wait until a submitted one is done.
+      batch_size: number of rows read at once by queries.
+    '''
+    def __init__(self, db, max_workers=4, max_pending=64, batch_size=1000):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._writer = ThreadPoolExecutor(1)
+        if getattr(db, '_pool', None) is None:
+            self._reader = self._writer
+        else:
+            self._reader = ThreadPoolExecutor(max_workers)
+        # Created on first use to be bound to the running loop
+        self._pending = None
+
+    async def _run(self, executor, function, *args, **kwargs):
+        if self._pending is None:
+            self._pending = asyncio.Semaphore(self.max_pending)
+        async with self._pending:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(executor, functools.partial(function, *args, **kwargs))
+
+    def _write(self, function, *args, **kwargs):
+        return self._run(self._writer, function, *args, **kwargs)
+
+    def _read(self, function, *args, **kwargs):
+        return self._run(self._reader, function, *args, **kwargs)
+
+    async def store_document(self, document, collection=None, id=None):
+        return await self._write(self.db.store_document, document, collection, id)
+
+    async def store_documents(self, documents, collection=None, batch_size=1000):
+        return await self._write(self.db.store_documents, documents, collection, batch_size)
+
+    async def commit(self):
+        return await self._write(self.db.commit)
+
+    async def rollback(self):
+        return await self._write(self.db.rollback)
+
+    async def execute_columns(self, query, params=None):
+        return await self._read(self.db.execute_columns, query, params)
+
+    async def traverse(self, start_ref, via, depth=None, direction='forward'):
+        return await self._read(self.db.traverse, start_ref, via, depth, direction)
+
+    def execute(self, query, params=None, values_only=False, after=None):
+        '''Return an AsyncResult that can be used with "async for" to
+        iterate over the rows selected by a query.
+        '''
+        return AsyncResult(self, query, params, values_only, after)
+
+    async def close(self):
+        '''Wait for submitted operations and stop threads.'''
+        await asyncio.get_event_loop().run_in_executor(None, self._shutdown)
+
+    def _shutdown(self):
+        self._writer.shutdown()
+        if self._reader is not self._writer:
+            self._reader.shutdown()
+
+
+class AsyncResult(object):
+    '''Asynchronous iterator over the rows of a query. Rows are read by
+    batches in a thread and the next batch is read while the current
+    one is processed. Iterating over batches() gives lists of rows.
+    '''
+    def __init__(self, adb, query, params, values_only, after):
+        self._adb = adb
+        self._query = query
+        self._params = params
+        self._values_only = values_only
+        self._after = after
+        self.result = None
+
+    async def batches(self):
+        adb = self._adb
+        self.result = await adb._read(adb.db.execute, self._query, self._params,
+                                      values_only=self._values_only,
+                                      batch_size=adb.batch_size,
+                                      after=self._after)
+        next_batch = None
+        try:
+            next_batch = asyncio.ensure_future(adb._read(self.result.fetchmany))
+            while True:
+                batch = await next_batch
+                next_batch = None
+                if not batch:
+                    break
+                next_batch = asyncio.ensure_future(adb._read(self.result.fetchmany))
+                yield batch
+        finally:
+            if next_batch is not None:
+                # Wait for the running read before closing the cursor
+                try:
+                    await next_batch
+                except Exception:
+                    pass
+            await adb._read(self.result.close)
+
+    async def __aiter__(self):
+        async for batch in self.batches():
+            for row in batch:
+                yield row
+
+    def continuation(self):
+        '''Return the continuation token of the last batch read (see
+        DoqapySqliteResult.continuation()).
+        '''
+        return self.result.continuation()
@@ -8,8 +8,9 @@ import six
 import os
 import os.path as osp
 import datetime
+import multiprocessing
+import re
 import sqlite3
-import dateutil
 from collections import OrderedDict
 
 from doqapy import (
@@ -36,46 +37,413 @@ from doqapy import (
     list_ref_field_type,
 )
 from doqapy.grammar import grammar
-from .ast_to_sqlite import ASTToSQLite
+from doqapy.codec import (
+    encode_list,
+    decode_list,
+    decode_text_list,
+    decode_datetime,
+    decode_date,
+    decode_time,
+    encode_epoch_datetime,
+    decode_epoch_datetime,
+    encode_epoch_date,
+    decode_epoch_date,
+    encode_epoch_time,
+    decode_epoch_time,
+)
+from .ast_to_sqlite import ASTToSQLite, list_key_parameter
+from .query_cache import QueryCache
+from .result import DoqapySqliteResult, decode_continuation
+from .pool import ConnectionPool
+from .functions import list_equality_modes, list_key, register_functions
+from .query_log import QueryLog
+from doqapy.stats import clock
+from doqapy.row import Row, RowSchema
+
+# Version of the storage format, it is stored in SQLite user_version.
+#   0: lists are stored with repr() of items joined by tabulations
+#   1: lists are stored as JSON arrays
+#   2: list tables are indexed on (value, list)
+#   3: list fields have an indexed hash column used for equality
+storage_version = 3
+
+
+def _bool_option(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+# Functions converting options given in a URL to constructor parameters
+_url_options = {
+    'query_cache_size': int,
+    'temporal_storage': str,
+    'pool': int,
+    'wal': _bool_option,
+    'query_log': _bool_option,
+    'list_equality': str,
+    'integer_refs': _bool_option,
+}
+
+
+
+def parse_url_options(storage):
+    '''Split the options (given as URL query parameters) from a SQLite
+    database name. Return the database name and a dictionary of
+    DoqapySqliteDatabase constructor parameters.
+    '''
+    storage, query = storage.split('?', 1) if '?' in storage else (storage, '')
+    options = {}
+    for name, value in six.moves.urllib.parse.parse_qsl(query):
+        convert = _url_options.get(name)
+        if convert is None:
+            raise ValueError('Invalid SQLite database option: %s' % name)
+        options[name] = convert(value)
+    return storage, options
 
         
 class DoqapySqliteDatabase(DoqapyDatabase):    
-    def __init__(self, sqlite_database):
+    '''
+    Doqapy database stored in a SQLite file. Parameters are:
+      sqlite_database: a valid value for a SQLite connection (e.g. a file
+                       name or ':memory:').
+      query_cache_size: maximum number of compiled queries kept in memory.
+      temporal_storage: the way datetime, date and time values are stored.
+                        It can only be chosen when the database is created.
+                        With 'iso' (the default) values are stored as text
+                        using isoformat(). With 'epoch' they are stored as
+                        integers (see doqapy.codec) ; this ensures that
+                        comparisons are correct and allows to use indices
+                        for range queries.
+      pool: if not 0, queries are executed with a pool of at most pool
+            read-only connections (one per concurrent query) whereas all
+            modifications are done with a single writer connection.
+            Queries only see committed data. It implies wal, otherwise
+            open query results would prevent the writer to commit.
+      wal: if True, the database uses SQLite write-ahead log. This allows
+           readers to work concurrently with the writer, each of them
+           seeing a consistent snapshot of the database. A database
+           already in WAL mode stays in this mode whatever this option.
+      query_log: if True, the fields used in the where clause of executed
+                 queries are counted in a QueryLog (in the query_log
+                 attribute) used by index_recommendations().
+      list_equality: the meaning of "=" and "!=" between lists. It can
+                     only be chosen when the database is created. With
+                     'ordered' (the default) lists are equal if they have
+                     the same items in the same order. With 'set' they
+                     are equal if they have the same distinct items. In
+                     both cases, an indexed hash of each list is used to
+                     find equal lists.
+      integer_refs: if True, each reference used in the database (as a
+                    document reference or as a value of a ref or
+                    list_ref field) is associated to an integer in a
+                    _refs table. These integers are stored in hidden
+                    indexed columns and used to compare references in
+                    queries (e.g. "subject.in_study = study"). References
+                    are still text in documents and query results. It can
+                    only be chosen when the database is created.
+    '''
+    temporal_storage_modes = ('iso', 'epoch')
+    list_equality_modes = list_equality_modes
+    
+    def __init__(self, sqlite_database, query_cache_size=128, temporal_storage=None,
+                 pool=0, wal=False, query_log=False, list_equality=None, integer_refs=None):
+        if temporal_storage is not None and temporal_storage not in self.temporal_storage_modes:
+            raise ValueError('Invalid temporal storage mode: %s' % temporal_storage)
+        if list_equality is not None and list_equality not in self.list_equality_modes:
+            raise ValueError('Invalid list equality mode: %s' % list_equality)
+        if (pool or wal) and sqlite_database in ('', ':memory:'):
+            raise ValueError('Connection pool and WAL mode require a database file')
         self.sqlite_database = sqlite_database
+        self.temporal_storage = temporal_storage
+        self.list_equality = list_equality
+        self.integer_refs = integer_refs
+        self.wal = bool(wal or pool)
         self._cnx = sqlite3.connect(self.sqlite_database, check_same_thread=False)
+        register_functions(self._cnx)
+        if pool:
+            self._pool = ConnectionPool(sqlite_database, pool)
+        else:
+            self._pool = None
+        # Collections are cached and the cache is cleared whenever
+        # SQLite schema version (incremented on each schema change,
+        # including those done by other connections) is modified.
+        self._collections_cache = {}
+        self._schema_version = None
+        # Compiled queries indexed by query text and schema version
+        self._query_cache = QueryCache(query_cache_size)
+        self._bulk_loading = False
+        self.query_log = (QueryLog() if query_log else None)
         self._init_database()
     
     def _init_database(self):
-        # Optimize database for a safe single client
-        self._cnx.execute('PRAGMA journal_mode = MEMORY')
-        self._cnx.execute('PRAGMA synchronous = OFF')
+        if not self.wal:
+            # WAL mode is persistent and may have been set by another
+            # connection that is still open. It is kept since changing
+            # the journal mode requires an exclusive access.
+            self.wal = self._cnx.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        if self.wal:
+            # WAL mode is persistent, it is safe with NORMAL
+            # synchronization.
+            self._cnx.execute('PRAGMA journal_mode = WAL')
+            self._cnx.execute('PRAGMA synchronous = NORMAL')
+        else:
+            # Optimize database for a safe single client
+            self._cnx.execute('PRAGMA journal_mode = MEMORY')
+            self._cnx.execute('PRAGMA synchronous = OFF')
         #self._cnx.execute('PRAGMA locking_mode = EXCLUSIVE')
         self._cnx.execute('PRAGMA cache_size = 8192')
         self._cnx.execute('PRAGMA page_size = 10000')
+        new_database = self._cnx.execute(
+            'SELECT count(*) FROM sqlite_master WHERE name="_collections"').fetchone()[0] == 0
+        if new_database:
+            self._cnx.execute('PRAGMA user_version = %d' % storage_version)
         self._cnx.execute(
             'CREATE TABLE IF NOT EXISTS _collections (name VARCHAR(256), tbl_name VARCHAR(256))')
         self._cnx.execute(
             'CREATE INDEX IF NOT EXISTS _collections_index ON _collections (name)')
+        self._cnx.execute(
+            'CREATE TABLE IF NOT EXISTS _settings (name VARCHAR(256), value VARCHAR(256))')
+        # Indices whose creation is postponed until the end of a bulk
+        # load. They are stored in the database in order to be created
+        # even if the bulk load is interrupted.
+        self._cnx.execute(
+            'CREATE TABLE IF NOT EXISTS _pending_indices (tbl_name VARCHAR(256), name VARCHAR(256), sql TEXT)')
+        settings = dict(self._cnx.execute('SELECT name, value FROM _settings'))
+        temporal_storage = settings.get('temporal_storage')
+        if temporal_storage is None:
+            # Databases created before the existence of this setting
+            # store temporal values as text.
+            temporal_storage = (self.temporal_storage or 'iso') if new_database else 'iso'
+            self._cnx.execute('INSERT INTO _settings VALUES (?, ?)', ('temporal_storage', temporal_storage))
+            self._cnx.commit()
+        elif self.temporal_storage not in (None, temporal_storage):
+            raise ValueError('Database %s uses %s temporal storage, it cannot be opened with %s temporal storage' % (self.sqlite_database, temporal_storage, self.temporal_storage))
+        self.temporal_storage = temporal_storage
+        list_equality = settings.get('list_equality')
+        if list_equality is None:
+            # Hashes of lists in older databases are computed during
+            # storage upgrade in ordered mode.
+            list_equality = (self.list_equality or 'ordered') if new_database else 'ordered'
+            self._cnx.execute('INSERT INTO _settings VALUES (?, ?)', ('list_equality', list_equality))
+            self._cnx.commit()
+        elif self.list_equality not in (None, list_equality):
+            raise ValueError('Database %s uses %s list equality, it cannot be opened with %s list equality' % (self.sqlite_database, list_equality, self.list_equality))
+        self.list_equality = list_equality
+        integer_refs = settings.get('integer_refs')
+        if integer_refs is None:
+            integer_refs = bool(self.integer_refs) if new_database else False
+            self._cnx.execute('INSERT INTO _settings VALUES (?, ?)', ('integer_refs', int(integer_refs)))
+            self._cnx.commit()
+        else:
+            integer_refs = bool(int(integer_refs))
+            if self.integer_refs not in (None, integer_refs):
+                raise ValueError('Database %s %s integer references, it cannot be opened with integer_refs=%s' % (self.sqlite_database, ('uses' if integer_refs else 'does not use'), self.integer_refs))
+        self.integer_refs = integer_refs
+        if integer_refs:
+            self._cnx.execute(
+                'CREATE TABLE IF NOT EXISTS _refs (id INTEGER PRIMARY KEY, ref TEXT UNIQUE)')
+        
+        # Conversion of values according to storage settings
+        self._field_type_to_sql, self._value_to_sql, self._sql_to_value = \
+            DoqapySqliteCollection.conversions(temporal_storage)
 
-    def commit(self):
+    @property
+    def storage_version(self):
+        '''Version of the storage format used in the database.'''
+        return self._cnx.execute('PRAGMA user_version').fetchone()[0]
+    
+    def upgrade_storage(self):
+        '''Convert in place a database using an old storage format to
+        the current one. Values stored with an older format can be read
+        without calling this method but they are decoded more slowly.
+        However, list tables are not filled before storage version 2,
+        therefore queries using "in" with a list field and distinct()
+        values of a list field raise a ValueError until this method is
+        called.
+        The conversion is done in a single transaction that is rolled
+        back if an error occurs.
+        '''
         self._cnx.commit()
+        self._begin()
+        try:
+            self._upgrade_storage(self.storage_version)
+        except:
+            self.rollback()
+            raise
+        self._cnx.commit()
+    
+    def _upgrade_storage(self, version):
+        if version < 1:
+            for collection in self.collections():
+                collection_impl = self.get_collection(collection)
+                for field, field_type in six.iteritems(collection_impl.fields):
+                    if field_type[0] is not list:
+                        continue
+                    decode = collection_impl._sql_to_value[field_type]
+                    encode = collection_impl._value_to_sql[field_type]
+                    sql = 'SELECT rowid, %s FROM %s WHERE substr(%s, 1, 1) != "["' % (field, collection_impl.table, field)
+                    values = [(encode(decode(value)), rowid) for rowid, value in self._cnx.execute(sql)]
+                    self._cnx.executemany('UPDATE %s SET %s = ? WHERE rowid = ?' % (collection_impl.table, field), values)
+        if version < 2:
+            # List tables were not filled by older versions. They are
+            # rebuilt from list columns and indexed on (value, list).
+            for collection in self.collections():
+                collection_impl = self.get_collection(collection)
+                encoders = collection_impl._encoders
+                for field, field_type in six.iteritems(collection_impl.fields):
+                    if field_type[0] is not list:
+                        continue
+                    decode = collection_impl._sql_to_value[field_type]
+                    item_to_sql = encoders[field][1]
+                    list_table = collection_impl._list_table % (collection_impl.table, field)
+                    self._cnx.execute('DROP INDEX IF EXISTS %s_index' % list_table)
+                    self._cnx.execute('DELETE FROM %s' % list_table)
+                    sql = 'SELECT rowid, %s FROM %s WHERE %s IS NOT NULL' % (field, collection_impl.table, field)
+                    items = ((rowid, i, item_to_sql(item))
+                             for rowid, value in self._cnx.execute(sql)
+                             for i, item in enumerate(decode(value)))
+                    self._cnx.executemany('INSERT INTO %s (list, i, value) VALUES (?, ?, ?)' % list_table, items)
+                    self._cnx.execute(collection_impl._list_index_sql % (list_table, list_table))
+            self._schema_changed()
+        if version < 3:
+            # Add and fill hash columns of list fields
+            for collection in self.collections():
+                collection_impl = self.get_collection(collection)
+                for field, field_type in six.iteritems(collection_impl.fields):
+                    if field_type[0] is not list or field in collection_impl._hashed_lists:
+                        continue
+                    collection_impl._create_hash_column(field)
+                    sql = 'SELECT rowid, %s FROM %s WHERE %s IS NOT NULL' % (field, collection_impl.table, field)
+                    hashes = [(list_key(value, self.list_equality)[0], rowid) for rowid, value in self._cnx.execute(sql)]
+                    self._cnx.executemany('UPDATE %s SET %s = ? WHERE rowid = ?' % (
+                        collection_impl.table, collection_impl._list_hash_column % field), hashes)
+            self._schema_changed()
+        self._cnx.execute('PRAGMA user_version = %d' % storage_version)
+    
+    def commit(self):
+        if self.listeners:
+            start = clock()
+            self._cnx.commit()
+            self._emit({'type': 'commit', 'time': clock() - start})
+        else:
+            self._cnx.commit()
     
     def rollback(self):
         self._cnx.rollback()
+        # Rollback restores the previous schema version therefore
+        # modifications done since the last commit cannot be detected
+        # and the version can be reused for another schema.
+        self._clear_collections_cache()
+        self._query_cache.clear()
+    
+    def _clear_collections_cache(self):
+        self._collections_cache.clear()
+        self._schema_version = None
+    
+    def _check_schema_version(self):
+        '''Clear collections cache if database schema had been modified
+        since the last call.
+        '''
+        version = self._cnx.execute('PRAGMA schema_version').fetchone()[0]
+        if version != self._schema_version:
+            self._collections_cache.clear()
+            self._schema_version = version
+        return version
+    
+    def _schema_changed(self):
+        '''Must be called after a schema modification that had been
+        taken into account in the cached collections.
+        '''
+        self._schema_version = self._cnx.execute('PRAGMA schema_version').fetchone()[0]
+    
+    def _ref_ids(self, refs):
+        '''Return a dictionary associating the integer identifier of
+        each of the given references. Missing identifiers are created.
+        '''
+        refs = list(set(refs))
+        self._cnx.executemany('INSERT OR IGNORE INTO _refs (ref) VALUES (?)', ((ref,) for ref in refs))
+        ids = {}
+        # Stay below the default maximum number of SQLite parameters
+        for i in six.moves.range(0, len(refs), 500):
+            chunk = refs[i:i + 500]
+            sql = 'SELECT ref, id FROM _refs WHERE ref IN (%s)' % ', '.join('?' for ref in chunk)
+            ids.update(self._cnx.execute(sql, chunk))
+        return ids
+    
+    def _create_index(self, table, name, sql):
+        '''Execute an index creation statement or postpone it during a
+        bulk load.
+        '''
+        if self._bulk_loading:
+            self._cnx.execute('INSERT INTO _pending_indices VALUES (?, ?, ?)', (table, name, sql))
+        else:
+            self._cnx.execute(sql)
+    
+    def _begin_bulk_load(self, drop_indices):
+        self._bulk_loading = True
+        if drop_indices:
+            indices = self._cnx.execute(
+                "SELECT tbl_name, name, sql FROM sqlite_master WHERE type='index' "
+                "AND sql IS NOT NULL AND tbl_name NOT IN ('_collections', '_settings', '_pending_indices')").fetchall()
+            for table, name, sql in indices:
+                self._cnx.execute('INSERT INTO _pending_indices VALUES (?, ?, ?)', (table, name, sql))
+                self._cnx.execute('DROP INDEX %s' % name)
+            self._cnx.commit()
+    
+    def _end_bulk_load(self):
+        self._bulk_loading = False
+    
+    def build_pending_indices(self):
+        '''Create the indices postponed by bulk_load(), including those of
+        an interrupted bulk load, and commit.
+        '''
+        pending = self._cnx.execute('SELECT rowid, sql FROM _pending_indices').fetchall()
+        for rowid, sql in pending:
+            self._cnx.execute(sql)
+            self._cnx.execute('DELETE FROM _pending_indices WHERE rowid = ?', (rowid,))
+            # Each index is committed to keep the work done if this
+            # method is interrupted.
+            self._cnx.commit()
+        if pending:
+            self._schema_changed()
     
     def _collection_to_table_name(self, collection):
         return collection.lower().replace('/', '__')
     
     def get_collection(self, collection, default=undefined):
+        self._check_schema_version()
+        collection_impl = self._collections_cache.get(collection)
+        if collection_impl is not None:
+            return collection_impl
         sql = 'SELECT tbl_name FROM _collections WHERE name="%s"' % collection
         result = self._cnx.execute(sql).fetchone()
         if result is not None:
-            return DoqapySqliteCollection(self._cnx, collection, result[0])
+            collection_impl = DoqapySqliteCollection(self, collection, result[0])
+            self._collections_cache[collection] = collection_impl
+            return collection_impl
         if default is undefined:
             raise ValueError('Collection "%s" does not exist' % collection)
         return default
 
+    def _check_list_tables(self):
+        '''Raise a ValueError if list tables are not filled (i.e. if the
+        database storage version is older than 2).
+        '''
+        version = self.storage_version
+        if version < 2:
+            raise ValueError('Database %s uses storage version %d where list items are not indexed, '
+                             'upgrade_storage() must be called to use "in" with list fields or '
+                             'distinct() on list fields' % (self.sqlite_database, version))
+    
+    def _begin(self):
+        '''Start a transaction if none is active. Python sqlite3 module
+        only starts transactions before data modifications ; this must be
+        called before schema modifications in order to be able to roll
+        them back.
+        '''
+        if not self._cnx.in_transaction:
+            self._cnx.execute('BEGIN')
+    
     def create_collection(self, collection):
+        self._begin()
         table = self._collection_to_table_name(collection)
         self._cnx.execute(
             'CREATE TABLE %s (_id CHAR(36), _ref VARCHAR(256))' % table)
@@ -87,10 +455,14 @@ class DoqapySqliteDatabase(DoqapyDatabase):
             "INSERT INTO %s VALUES (?, ?)" % fields_table, [
                 ('_id', _field_type_to_string[text_field_type]),
                 ('_ref', _field_type_to_string[text_field_type])])
-        collection_impl = DoqapySqliteCollection(self._cnx, collection, table)
+        collection_impl = DoqapySqliteCollection(self, collection, table)
         collection_impl.create_index('_id')
         collection_impl.create_index('_ref')
+        if self.integer_refs:
+            collection_impl._create_refid_column('_ref')
         self._cnx.execute('INSERT INTO _collections VALUES ("%s", "%s")' % (collection, table))
+        self._collections_cache[collection] = collection_impl
+        self._schema_changed()
         return collection_impl
         
     def collections(self):
@@ -107,37 +479,563 @@ class DoqapySqliteDatabase(DoqapyDatabase):
         for table in tables:
             self._cnx.execute('DROP TABLE %s' % table)
         self._cnx.commit()
+        self._clear_collections_cache()
+        self._query_cache.clear()
         self._cnx.execute('VACUUM')
         self._init_database()
     
     
-    def parse_query(self, query):
-        ast = grammar.parse(query)
-        parser = ASTToSQLite(self)
-        sql = parser.parse_query(ast)
+    def parse_query(self, query, event=None):
+        '''Compile a query to a dictionary containing the SQL code
+        ("sql" item), the selected fields names and types ("fields" item),
+        the functions converting SQL values of these fields to Python
+        ("decoders" item, None for values that do not need conversion)
+        and the functions converting the values given for "?" parameters
+        to SQL ("parameters" item). If the query is sorted or limited, the
+        number of sort key columns added at the end of the selected ones
+        is in the "hidden" item and the "keyset" item contains the query
+        variant used for keyset pagination. Otherwise the "partition" item
+        contains the query variant restricted to a range of rowids used
+        by execute_parallel(). The (collection, field) pairs used in the
+        where clause are in the "predicates" item. Compiled queries are kept in a LRU
+        cache whose size is given by the query_cache_size constructor
+        parameter. If event is given, it is an instrumentation event
+        dictionary where cache use and compilation times are recorded.
+        '''
+        key = (query, self._check_schema_version())
+        compiled = self._query_cache.get(key)
+        if compiled is None:
+            if event is not None:
+                start = clock()
+            ast = grammar.parse(query)
+            if event is not None:
+                parsed = clock()
+            parser = ASTToSQLite(self)
+            sql = parser.parse_query(ast)
+            fields = list(six.itervalues(parser.columns))
+            compiled = {
+                'sql': sql,
+                'fields': fields,
+                'decoders': [self._sql_to_value.get(j) for i, j in fields],
+                'parameters': [self._parameter_encoder(i) for i in parser.parameters],
+                'hidden': parser.hidden,
+                'keyset': parser.keyset,
+                'partition': parser.partition,
+                'predicates': parser.predicates,
+            }
+            self._query_cache.put(key, compiled)
+            if event is not None:
+                event['cache_hit'] = False
+                event['parse_time'] = parsed - start
+                event['compile_time'] = clock() - parsed
+        return compiled
+    
+    def parse_distinct(self, field, where=None, counts=False):
+        '''Compile a request for the distinct values of a field to a
+        dictionary similar to the one returned by parse_query().
+        '''
+        key = ('distinct', field, where, counts, self._check_schema_version())
+        compiled = self._query_cache.get(key)
+        if compiled is None:
+            if where is None:
+                node = None
+            else:
+                node = grammar.parse('where %s' % where).children[1].children[0]
+            parser = ASTToSQLite(self)
+            sql = parser.parse_distinct(field, node, counts)
+            fields = list(six.itervalues(parser.columns))
+            compiled = {
+                'sql': sql,
+                'fields': fields,
+                'decoders': [self._sql_to_value.get(j) for i, j in fields],
+                'parameters': [self._parameter_encoder(i) for i in parser.parameters],
+                'predicates': parser.predicates,
+            }
+            self._query_cache.put(key, compiled)
+        return compiled
+    
+    def distinct(self, field, where=None, params=None, counts=False, batch_size=1000):
+        '''Iterates over the distinct values of a field given as
+        "<collection>.<field>". If where is given, it is a boolean
+        expression (as in the where clause of a query, possibly using
+        "?" parameters given in params) selecting the documents whose
+        values are considered. For list fields, the items of the lists are
+        returned. If counts is True, (value, count) pairs are returned
+        where count is the number of selected documents having the value.
+        '''
+        query = self.parse_distinct(field, where, counts)
+        result = self.execute(query, params, values_only=True, batch_size=batch_size)
+        if counts:
+            return iter(result)
+        return (row[0] for row in result)
+    
+    def query_cache_info(self):
+        '''Return a named tuple (hits, misses, maxsize, currsize) with
+        the compiled queries cache statistics.
+        '''
+        return self._query_cache.info()
+        
+    def _parameter_encoder(self, parameter_type):
+        '''Return the function converting a "?" parameter value to SQL
+        (None if no conversion is necessary).
+        '''
+        if parameter_type is not None and parameter_type[0] == list_key_parameter:
+            return ListKeyEncoder(self._value_to_sql[parameter_type[1]], self.list_equality)
+        return self._value_to_sql.get(parameter_type)
+    
+    def _sql_parameters(self, query, params, seek=None, skip=()):
+        '''Return the list of SQL values corresponding to the parameters
+        of a query. seek can be a (position, values) pair giving values
+        to insert before the parameter at the given position. skip
+        contains the positions of parameters that are not used.
+        '''
+        encoders = query['parameters']
+        if params is None:
+            params = ()
+        if len(params) != len(encoders):
+            raise ValueError('Query requires %d parameter(s) but %d were given' % (len(encoders), len(params)))
+        result = []
+        for i, (encoder, v) in enumerate(zip(encoders, params)):
+            if seek is not None and seek[0] == i:
+                result.extend(seek[1])
+            if i in skip:
+                continue
+            if isinstance(encoder, ListKeyEncoder):
+                # Lists compared with "=" need two SQL values
+                result.extend(encoder(v))
+            else:
+                result.append(v if encoder is None or v is None else encoder(v))
+        if seek is not None and seek[0] == len(encoders):
+            result.extend(seek[1])
+        return result
+    
+    def execute(self, query, params=None, values_only=False, batch_size=1000, after=None,
+                resolve_refs=None):
+        '''Execute a query and return a DoqapySqliteResult iterating
+        over the selected documents. A value must be given in params for
+        each "?" in the query. These values are bound to the SQL statement
+        after having been converted according to the field they are
+        compared to. Rows are read from SQLite by batches of batch_size
+        rows. Each row is a doqapy.row.Row mapping or a tuple if
+        values_only is True.
+        For queries using "order by" or "limit", after can be a token
+        returned by the continuation() method of a previous result of the
+        same query. In that case, only rows located after the last row
+        read in the previous result are selected. This uses the sort keys
+        (that should not be NULL) in the WHERE clause and therefore
+        does not need to skip the previous rows as OFFSET does.
+        resolve_refs can be a list of column names (as in result rows) of ref or list_ref
+        type. In each row, the references of these columns are replaced by
+        the referenced documents (as dictionaries, None for a reference to
+        a missing document). Documents are read with one query per batch
+        of rows and per referenced collection.
+        '''
+        event = self._query_event(query)
+        if not isinstance(query,dict):
+            query = self.parse_query(query, event)
+        if self.query_log is not None:
+            self.query_log.record(query.get('predicates', ()))
+        sql = query['sql']
+        if after is None:
+            sql_parameters = self._sql_parameters(query, params)
+        else:
+            keyset = query.get('keyset')
+            if keyset is None:
+                raise ValueError('Keyset pagination requires a query with "order by" or "limit" and without aggregation')
+            keys = decode_continuation(after)
+            sql = keyset['sql']
+            seek = (keyset['position'], [keys[i] for i in keyset['parameters']])
+            sql_parameters = self._sql_parameters(query, params, seek, keyset['skip'])
+        resolve = None
+        if resolve_refs:
+            resolve = self._ref_resolver(query['fields'], resolve_refs)
+        if event is None:
+            cursor, release = self._read_cursor(sql, sql_parameters)
+            emit = None
+        else:
+            event['sql'] = sql
+            executed = clock()
+            cursor, release = self._read_cursor(sql, sql_parameters)
+            event['execute_time'] = clock() - executed
+            emit = self._emit
+        return DoqapySqliteResult(cursor, [i[0] for i in query['fields']],
+                                  query['decoders'], values_only=values_only,
+                                  batch_size=batch_size,
+                                  hidden=query.get('hidden', 0),
+                                  release=release, event=event, emit=emit,
+                                  resolve=resolve)
+    
+    def _ref_resolver(self, fields, resolve_refs):
+        '''Return a function replacing, in a list of decoded rows, the
+        references of the resolve_refs columns by the referenced
+        documents. It is called with the connection used to read the
+        rows.
+        '''
+        columns = []
+        for name in resolve_refs:
+            for i, (field, field_type) in enumerate(fields):
+                if field == name:
+                    break
+            else:
+                raise ValueError('Cannot resolve references of %s: it is not a selected column' % name)
+            if field_type not in (ref_field_type, list_ref_field_type):
+                raise ValueError('Cannot resolve references of %s: it is not a ref or list_ref field' % name)
+            columns.append((i, field_type == list_ref_field_type))
+        
+        def resolve(cnx, rows):
+            refs = set()
+            for row in rows:
+                for i, is_list in columns:
+                    if row[i] is not None:
+                        if is_list:
+                            refs.update(row[i])
+                        else:
+                            refs.add(row[i])
+            documents = self._documents_by_ref(cnx, refs)
+            result = []
+            for row in rows:
+                row = list(row)
+                for i, is_list in columns:
+                    if row[i] is not None:
+                        if is_list:
+                            row[i] = [documents.get(ref) for ref in row[i]]
+                        else:
+                            row[i] = documents.get(row[i])
+                result.append(tuple(row))
+            return result
+        return resolve
+    
+    def _documents_by_ref(self, cnx, refs):
+        '''Read the documents whose reference is in refs and return a
+        dictionary indexed by reference. References to unknown
+        collections are ignored.
+        '''
+        by_collection = {}
+        for ref in refs:
+            collection = ref.rsplit('/', 1)[0]
+            by_collection.setdefault(collection, []).append(ref)
+        documents = {}
+        for collection, refs in six.iteritems(by_collection):
+            collection_impl = self.get_collection(collection, None)
+            if collection_impl is not None:
+                documents.update(collection_impl._documents_by_ref(cnx, refs))
+        return documents
+    
+    def _query_event(self, query):
+        '''Return a new instrumentation event for a query or None if
+        the database has no listener.
+        '''
+        if not self.listeners:
+            return None
         return {
-            'sql': sql,
-            'fields': list(six.itervalues(parser.columns)),
+            'type': 'query',
+            'query': (None if isinstance(query, dict) else query),
+            'sql': None,
+            'cache_hit': True,
+            'parse_time': 0,
+            'compile_time': 0,
+            'execute_time': 0,
+            'fetch_time': 0,
+            'decode_time': 0,
+            'rows': 0,
         }
+    
+    _traverse_directions = ('forward', 'backward', 'both')
+    
+    def traverse(self, start_ref, via, depth=None, direction='forward'):
+        '''Return the documents reachable from the document whose
+        reference is start_ref by following reference fields (see
+        DoqapyDatabase.traverse()). The traversal is done by SQLite in a
+        single recursive query (requires SQLite >= 3.34). Visited paths
+        are stored as text in order to detect cycles ; the number of
+        paths can grow quickly in highly connected graphs, therefore
+        depth should be given for such traversals.
+        '''
+        sql, parameters = self._traverse_sql(via, depth, direction)
+        cursor, release = self._read_cursor(sql, [start_ref, start_ref] + parameters)
+        try:
+            return cursor.fetchall()
+        finally:
+            if release is not None:
+                release()
+    
+    def _traverse_sql(self, via, depth, direction):
+        '''Return the recursive SQL query used by traverse() and its
+        parameters (except the two first ones that are the start
+        reference).
+        '''
+        if direction not in self._traverse_directions:
+            raise ValueError('Invalid traversal direction %s, expect one of %s' % (direction, ', '.join(self._traverse_directions)))
+        edges = []
+        for name in via:
+            split = name.rsplit('.', 1)
+            if len(split) == 2:
+                collections = [split[0]]
+                field = split[1]
+            else:
+                collections = self.collections()
+                field = name
+            found = False
+            for collection in collections:
+                collection_impl = self.get_collection(collection)
+                field_type = collection_impl.fields.get(field)
+                if field_type in (ref_field_type, list_ref_field_type):
+                    edges.append((collection_impl, field, field_type))
+                    found = True
+                elif len(split) == 2:
+                    raise ValueError('Cannot traverse %s: it is not a ref or list_ref field' % name)
+            if not found:
+                raise ValueError('Cannot traverse %s: no collection has such a ref or list_ref field' % name)
         
-    def execute(self, query, values_only=False):
+        # Each recursive step is given as the expression of the next
+        # reference and the joins from the current row "t" of the
+        # traversal.
+        steps = []
+        for collection_impl, field, field_type in edges:
+            table = collection_impl.table
+            if direction in ('forward', 'both'):
+                if field_type == ref_field_type:
+                    steps.append(('c.%s' % field, 'JOIN %s c ON c._ref = t.ref' % table))
+                else:
+                    steps.append(('j.value', 'JOIN %s c ON c._ref = t.ref JOIN json_each(c.%s) j' % (table, field)))
+            if direction in ('backward', 'both'):
+                if field_type == ref_field_type:
+                    refid_column = collection_impl.refid_column(field)
+                    if refid_column is None:
+                        condition = 'c.%s = t.ref' % field
+                    else:
+                        condition = 'c.%s = (SELECT id FROM _refs WHERE ref = t.ref)' % refid_column
+                    steps.append(('c._ref', 'JOIN %s c ON %s' % (table, condition)))
+                else:
+                    list_table = collection_impl._list_table % (table, field)
+                    steps.append(('c._ref', 'JOIN %s l ON l.value = t.ref JOIN %s c ON c.rowid = l.list' % (list_table, table)))
+        parameters = []
+        recursive = []
+        for next, joins in steps:
+            # A reference already in the path is a cycle
+            conditions = ["%s IS NOT NULL AND instr(t.path, '|' || %s || '|') = 0" % (next, next)]
+            if depth is not None:
+                conditions.append('t.depth < ?')
+                parameters.append(depth)
+            recursive.append("SELECT %s, t.depth + 1, t.path || %s || '|' FROM traversal t %s WHERE %s"
+                             % (next, next, joins, ' AND '.join(conditions)))
+        sql = ("WITH RECURSIVE traversal(ref, depth, path) AS ("
+               "SELECT ?, 0, '|' || ? || '|' UNION ALL %s) "
+               "SELECT ref, min(depth) AS d FROM traversal WHERE depth > 0 "
+               "GROUP BY ref ORDER BY d, ref" % ' UNION ALL '.join(recursive))
+        return sql, parameters
+    
+    def explain(self, query, params=None):
+        '''Return a dictionary with the SQL code of a query ("sql" item)
+        and the SQLite query plan ("plan" item) as a list of lines
+        indented according to the plan tree. In the plan, tables and
+        indices are named after the collections and fields they
+        implement : a collection table has the collection name, the index
+        of a field is named "<collection>.<field>" and the items table of
+        a list field (as well as its index) is named
+        "<collection>.<field>[*]". Hash and integer reference indices
+        have a "(hash)" or "(refid)" suffix. If params is None, NULL is used for
+        all "?" parameters.
+        '''
         if not isinstance(query,dict):
             query = self.parse_query(query)
-        sql = query['sql']
-        fields = [(i, DoqapySqliteCollection._sql_to_value.get(j,lambda x: x)) for i, j in query['fields']]
-        print('!sql!', sql)
-        cursor = self._cnx.execute(sql)
-        for row in cursor:
-            if values_only:
-                yield tuple(fields[i][1](value) for i, value in enumerate(row))
-            else:
-                yield dict((fields[i][0], fields[i][1](value)) for i, value in enumerate(row))
+        if params is None:
+            params = [None] * len(query['parameters'])
+        sql_parameters = self._sql_parameters(query, params)
+        names = {}
+        for collection in self.collections():
+            collection_impl = self.get_collection(collection)
+            table = collection_impl.table
+            names[table] = collection
+            for field, field_type in six.iteritems(collection_impl.fields):
+                names[collection_impl._index_name % (table, field)] = '%s.%s' % (collection, field)
+                if field_type[0] is list:
+                    list_table = collection_impl._list_table % (table, field)
+                    names[list_table] = names['%s_index' % list_table] = '%s.%s[*]' % (collection, field)
+                    names['%s_hash' % list_table] = '%s.%s(hash)' % (collection, field)
+                    names['%s_refid' % list_table] = '%s.%s[*](refid)' % (collection, field)
+                refid_column = collection_impl.refid_column(field)
+                if refid_column is not None:
+                    names[collection_impl._index_name % (table, refid_column)] = '%s.%s(refid)' % (collection, field)
+        rename = lambda match: names.get(match.group(0), match.group(0))
+        depths = {0: -1}
+        plan = []
+        for id, parent, notused, detail in self._cnx.execute('EXPLAIN QUERY PLAN %s' % query['sql'], sql_parameters):
+            depths[id] = depths.get(parent, -1) + 1
+            plan.append('%s%s' % ('  ' * depths[id], re.sub(r'\w+', rename, detail)))
+        return {
+            'sql': query['sql'],
+            'plan': plan,
+        }
+    
+    def index_recommendations(self, min_count=1):
+        '''Return a list of (collection, field, count) for fields without
+        index that had been used in the where clause of at least
+        min_count queries since the query log creation. Fields are sorted
+        by decreasing count. Requires the query_log constructor option.
+        '''
+        if self.query_log is None:
+            raise ValueError('Index recommendations require a database opened with query_log option')
+        result = []
+        indices = {}
+        for (collection, field), count in self.query_log.counts():
+            if count < min_count:
+                break
+            collection_impl = self.get_collection(collection, None)
+            if collection_impl is None:
+                continue
+            field_type = collection_impl.fields.get(field)
+            # Indices on list columns are useless, items are in a table
+            # indexed by document.
+            if field_type is None or field_type[0] is list:
+                continue
+            # References are compared with indexed integer identifiers
+            if collection_impl.refid_column(field) is not None:
+                continue
+            if collection not in indices:
+                indices[collection] = set(collection_impl.indices())
+            if field not in indices[collection]:
+                result.append((collection, field, count))
+        return result
+    
+    def create_recommended_indices(self, min_count=1):
+        '''Create (and commit) the indices returned by
+        index_recommendations() and return their list.
+        '''
+        recommendations = self.index_recommendations(min_count)
+        for collection, field, count in recommendations:
+            self.get_collection(collection).create_index(field)
+        self.commit()
+        return recommendations
+    
+    def _read_cursor(self, sql, parameters):
+        '''Execute a read-only SQL statement and return the cursor and a
+        function that must be called when the cursor is no longer used
+        (or None).
+        '''
+        if self._pool is None:
+            return self._cnx.execute(sql, parameters), None
+        cnx = self._pool.acquire()
+        try:
+            cursor = cnx.execute(sql, parameters)
+        except:
+            self._pool.release(cnx)
+            raise
+        return cursor, lambda: self._pool.release(cnx)
+    
+    def execute_parallel(self, query, params=None, processes=None, partitions=None,
+                         ordered=False, values_only=False):
+        '''Execute a query in several processes and iterate over the
+        selected documents. The documents of the first collection of the
+        query are split in ranges of rowids (by default four times the
+        number of processes) and each range is selected and decoded
+        by a worker process using its own read-only connection. If
+        ordered is True, rows are returned in the order of the documents
+        of the first collection, otherwise they are returned as soon as
+        they are available. processes is the number of worker processes
+        (by default the number of CPUs). Only queries without "order by",
+        "limit", "offset", "group by" and aggregation functions can be
+        executed this way and only committed data is seen. This method
+        is useful to read a large part of a database file since value
+        decoding is done in parallel.
+        '''
+        from .parallel import parallel_rows
+        
+        if self.sqlite_database in ('', ':memory:'):
+            raise ValueError('Parallel execution requires a database file')
+        if not isinstance(query,dict):
+            query = self.parse_query(query)
+        partition = query.get('partition')
+        if partition is None:
+            raise ValueError('Parallel execution requires a query without "order by", "limit", "offset", "group by" or aggregation')
+        sql_parameters = self._sql_parameters(query, params)
+        if self.query_log is not None:
+            self.query_log.record(query['predicates'])
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if partitions is None:
+            partitions = 4 * processes
+        first, last = self._cnx.execute('SELECT min(rowid), max(rowid) FROM %s' % partition['table']).fetchone()
+        if first is None:
+            ranges = []
+        else:
+            step = max(1, (last - first + partitions) // partitions)
+            ranges = [(i, min(i + step - 1, last)) for i in six.moves.range(first, last + 1, step)]
+        return parallel_rows(self.sqlite_database, self.temporal_storage, partition['sql'],
+                             sql_parameters, ranges, query['fields'], processes,
+                             ordered=ordered, values_only=values_only)
+    
+    def execute_columns(self, query, params=None, batch_size=10000):
+        '''Execute a query and return an OrderedDict whose keys are
+        the selected fields names and values are NumPy arrays containing
+        all the values of the field. Integer, float and boolean fields
+        give numeric arrays (masked arrays if there are NULL integers or
+        booleans), datetime and date fields give datetime64 arrays, time
+        fields give timedelta64 arrays and other fields give arrays of
+        Python objects. Rows are read by batches of batch_size rows to
+        fill preallocated arrays. This method requires NumPy.
+        '''
+        # Avoid mandatory dependency on numpy for those
+        # who do not call this function
+        from .columns import fetch_columns
+        
+        event = self._query_event(query)
+        if not isinstance(query,dict):
+            query = self.parse_query(query, event)
+        if self.query_log is not None:
+            self.query_log.record(query.get('predicates', ()))
+        if event is not None:
+            executed = clock()
+        cursor, release = self._read_cursor(query['sql'], self._sql_parameters(query, params))
+        try:
+            if event is not None:
+                fetched = clock()
+            arrays = fetch_columns(cursor, query['fields'], query['decoders'],
+                                   self.temporal_storage, batch_size)
+        finally:
+            cursor.close()
+            if release is not None:
+                release()
+        if event is not None:
+            event['sql'] = query['sql']
+            event['execute_time'] = fetched - executed
+            event['fetch_time'] = clock() - fetched
+            event['rows'] = (len(arrays[0]) if arrays else 0)
+            event['time'] = (event['parse_time'] + event['compile_time'] +
+                             event['execute_time'] + event['fetch_time'])
+            self._emit(event)
+        return OrderedDict(zip((i[0] for i in query['fields']), arrays))
+    
+
+class ListKeyEncoder(object):
+    '''Convert a "?" parameter compared to a list field to the (hash,
+    text) pair of SQL values compared to the hash column and to the
+    content of the field.
+    '''
+    def __init__(self, to_sql, list_equality):
+        self.to_sql = to_sql
+        self.list_equality = list_equality
     
+    def __call__(self, value):
+        if value is None:
+            return (None, None)
+        return list_key(self.to_sql(value), self.list_equality)
+
         
 class DoqapySqliteCollection(DoqapyCollection):
     _fields_table = '_%s_fields'
     _index_name = '_%s_%s'
     _list_table = '_%s_list_%s'
+    # The index of list tables is used to find the documents containing
+    # a value
+    _list_index_sql = 'CREATE INDEX %s_index ON %s (value, list)'
+    # Hidden column containing the hash of a list field
+    _list_hash_column = '_hash_%s'
+    _list_hash_index_sql = 'CREATE INDEX %s_hash ON %s (%s)'
+    # With integer references, hidden column containing the integer
+    # identifier of a reference field (or of the document reference)
+    _refid_column = '_refid_%s'
+    _list_refid_index_sql = 'CREATE INDEX %s_refid ON %s (refid, list)'
     _field_type_to_sql = {
         text_field_type: 'text',
         int_field_type: 'int',
@@ -160,38 +1058,86 @@ class DoqapySqliteCollection(DoqapyCollection):
         datetime_field_type: lambda x: x.isoformat(),
         date_field_type: lambda x: x.isoformat(),
         time_field_type: lambda x: x.isoformat(),
-        list_text_field_type: lambda x: '\t'.join(repr(i) for i in x),
-        list_int_field_type: lambda x: '\t'.join(repr(i) for i in x),
-        list_float_field_type: lambda x: '\t'.join(repr(i) for i in x),
-        list_bool_field_type: lambda x: '\t'.join(repr(i) for i in x),
-        list_datetime_field_type: lambda x: '\t'.join(i.isoformat() for i in x),
-        list_date_field_type: lambda x: '\t'.join(i.isoformat() for i in x),
-        list_time_field_type: lambda x: '\t'.join(i.isoformat() for i in x),
-        list_ref_field_type: lambda x: '\t'.join(repr(i) for i in x),
+        list_text_field_type: encode_list,
+        list_int_field_type: encode_list,
+        list_float_field_type: encode_list,
+        list_bool_field_type: encode_list,
+        list_datetime_field_type: lambda x: encode_list([i.isoformat() for i in x]),
+        list_date_field_type: lambda x: encode_list([i.isoformat() for i in x]),
+        list_time_field_type: lambda x: encode_list([i.isoformat() for i in x]),
+        list_ref_field_type: encode_list,
     }
     _sql_to_value = {
         bool_field_type: lambda x : (None if x is None else bool(x)),
-        datetime_field_type: lambda x: dateutil.parser.parse(x),
-        date_field_type: lambda x: dateutil.parser.parse(x).date(),
-        time_field_type: lambda x: dateutil.parser.parse(x).time(),
-        list_text_field_type: lambda x: (None if x is None else [eval(i) for i in x.split('\t')]),
-        list_int_field_type: lambda x: (None if x is None else [eval(i) for i in x.split('\t')]),
-        list_float_field_type: lambda x: (None if x is None else [eval(i) for i in x.split('\t')]),
-        list_bool_field_type: lambda x: (None if x is None else [eval(i) for i in x.split('\t')]),
-        list_datetime_field_type: lambda x: (None if x is None else [dateutil.parser.parse(i) for i in x.split('\t')]),
-        list_date_field_type: lambda x: (None if x is None else [dateutil.parser.parse(i).date() for i in x.split('\t')]),
-        list_time_field_type: lambda x: (None if x is None else [dateutil.parser.parse(i).time() for i in x.split('\t')]),
-        list_ref_field_type: lambda x: (None if x is None else [eval(i) for i in x.split('\t')]),
+        datetime_field_type: lambda x: (None if x is None else decode_datetime(x)),
+        date_field_type: lambda x: (None if x is None else decode_date(x)),
+        time_field_type: lambda x: (None if x is None else decode_time(x)),
+        list_text_field_type: lambda x: (None if x is None else decode_list(x)),
+        list_int_field_type: lambda x: (None if x is None else decode_list(x)),
+        list_float_field_type: lambda x: (None if x is None else decode_list(x)),
+        list_bool_field_type: lambda x: (None if x is None else decode_list(x)),
+        list_datetime_field_type: lambda x: (None if x is None else [decode_datetime(i) for i in decode_text_list(x)]),
+        list_date_field_type: lambda x: (None if x is None else [decode_date(i) for i in decode_text_list(x)]),
+        list_time_field_type: lambda x: (None if x is None else [decode_time(i) for i in decode_text_list(x)]),
+        list_ref_field_type: lambda x: (None if x is None else decode_list(x)),
     }
     
-    def __init__(self, connection, collection, table):
-        self.cnx = connection
+    _epoch_field_type_to_sql = {
+        datetime_field_type: 'integer',
+        date_field_type: 'integer',
+        time_field_type: 'integer',
+    }
+    _epoch_value_to_sql = {
+        datetime_field_type: encode_epoch_datetime,
+        date_field_type: encode_epoch_date,
+        time_field_type: encode_epoch_time,
+        list_datetime_field_type: lambda x: encode_list([encode_epoch_datetime(i) for i in x]),
+        list_date_field_type: lambda x: encode_list([encode_epoch_date(i) for i in x]),
+        list_time_field_type: lambda x: encode_list([encode_epoch_time(i) for i in x]),
+    }
+    _epoch_sql_to_value = {
+        datetime_field_type: lambda x: (None if x is None else decode_epoch_datetime(x)),
+        date_field_type: lambda x: (None if x is None else decode_epoch_date(x)),
+        time_field_type: lambda x: (None if x is None else decode_epoch_time(x)),
+        list_datetime_field_type: lambda x: (None if x is None else [decode_epoch_datetime(i) for i in decode_list(x)]),
+        list_date_field_type: lambda x: (None if x is None else [decode_epoch_date(i) for i in decode_list(x)]),
+        list_time_field_type: lambda x: (None if x is None else [decode_epoch_time(i) for i in decode_list(x)]),
+    }
+    
+    @classmethod
+    def conversions(cls, temporal_storage):
+        '''Return the dictionaries (field_type_to_sql, value_to_sql,
+        sql_to_value) used with a temporal storage mode.
+        '''
+        field_type_to_sql = dict(cls._field_type_to_sql)
+        value_to_sql = dict(cls._value_to_sql)
+        sql_to_value = dict(cls._sql_to_value)
+        if temporal_storage == 'epoch':
+            field_type_to_sql.update(cls._epoch_field_type_to_sql)
+            value_to_sql.update(cls._epoch_value_to_sql)
+            sql_to_value.update(cls._epoch_sql_to_value)
+        return field_type_to_sql, value_to_sql, sql_to_value
+    
+    def __init__(self, db, collection, table):
+        self.db = db
+        self.cnx = db._cnx
+        # Conversions depend on database storage settings
+        self._field_type_to_sql = db._field_type_to_sql
+        self._value_to_sql = db._value_to_sql
+        self._sql_to_value = db._sql_to_value
         self.collection = collection
         self.table = table
+        # INSERT statements indexed by the columns they contain
+        self._insert_sql = {}
+        self._encoders_cache = None
         # read fields
         self._fields = OrderedDict((k, _string_to_field_type[v]) for k, v in 
-            connection.execute(
+            self.cnx.execute(
                 'SELECT name, type from %s' % self._fields_table % table))
+        # List fields having a hash column
+        columns = set(row[1] for row in self.cnx.execute('PRAGMA table_info(%s)' % table))
+        self._hashed_lists = set(field for field, field_type in six.iteritems(self._fields)
+                                 if field_type[0] is list and self._list_hash_column % field in columns)
     
     @property
     def fields(self):
@@ -200,32 +1146,98 @@ class DoqapySqliteCollection(DoqapyCollection):
         '''
         return self._fields
 
+    @property
+    def _encoders(self):
+        '''Return a dictionary whose keys are field names and values are
+        a pair (to_sql, item_to_sql). to_sql converts a value to its SQL
+        representation (None if no conversion is necessary) and, for
+        list fields, item_to_sql converts an item for the list table.
+        '''
+        if self._encoders_cache is None:
+            identity = lambda x: x
+            encoders = {}
+            for field, field_type in six.iteritems(self._fields):
+                if field_type[0] is list:
+                    item_to_sql = self._value_to_sql.get((field_type[1], None), identity)
+                else:
+                    item_to_sql = None
+                encoders[field] = (self._value_to_sql.get(field_type), item_to_sql)
+            self._encoders_cache = encoders
+        return self._encoders_cache
+
     def create_field(self, field_name, field_type):
+        self.db._begin()
         self.cnx.execute(
             'ALTER TABLE %s ADD COLUMN %s %s' % (self.table, field_name,
             self._field_type_to_sql[field_type]))
         fields_table = self._fields_table % self.table
         if field_type[0] is list:
             list_table = self._list_table % (self.table, field_name)
-            self.cnx.execute('CREATE TABLE %s (list, i, value)' % list_table)
-            self.cnx.execute('CREATE INDEX %s_index ON %s (list)' % (list_table, list_table))
+            if self.db.integer_refs and field_type == list_ref_field_type:
+                self.cnx.execute('CREATE TABLE %s (list, i, value, refid INTEGER)' % list_table)
+                self.db._create_index(list_table, '%s_refid' % list_table,
+                                      self._list_refid_index_sql % (list_table, list_table))
+            else:
+                self.cnx.execute('CREATE TABLE %s (list, i, value)' % list_table)
+            self.db._create_index(list_table, '%s_index' % list_table,
+                                  self._list_index_sql % (list_table, list_table))
+            self._create_hash_column(field_name)
+        elif self.db.integer_refs and field_type == ref_field_type:
+            self._create_refid_column(field_name)
         self.cnx.execute(
             "INSERT INTO %s VALUES (?, ?)" % fields_table,
             (field_name, _field_type_to_string[field_type]))
         self._fields[field_name] = field_type
+        self._encoders_cache = None
+        self.db._schema_changed()
         return self._fields
     
+    def _create_hash_column(self, field_name):
+        hash_column = self._list_hash_column % field_name
+        list_table = self._list_table % (self.table, field_name)
+        self.cnx.execute('ALTER TABLE %s ADD COLUMN %s INTEGER' % (self.table, hash_column))
+        self.db._create_index(self.table, '%s_hash' % list_table,
+                              self._list_hash_index_sql % (list_table, self.table, hash_column))
+        self._hashed_lists.add(field_name)
+    
+    def _create_refid_column(self, field_name):
+        refid_column = self._refid_column % field_name
+        self.cnx.execute('ALTER TABLE %s ADD COLUMN %s INTEGER' % (self.table, refid_column))
+        index = self._index_name % (self.table, refid_column)
+        self.db._create_index(self.table, index,
+                              'CREATE INDEX %s ON %s (%s)' % (index, self.table, refid_column))
+    
+    def refid_column(self, field_name):
+        '''Return the hidden column containing the integer identifiers
+        of the references stored in a field (None if the database does
+        not use integer references or if the field is not a reference).
+        '''
+        if self.db.integer_refs and (field_name == '_ref' or
+                                     self._fields.get(field_name) == ref_field_type):
+            return self._refid_column % field_name
+        return None
+    
     def create_index(self, field_name):
+        self.db._begin()
         index = self._index_name % (self.table, field_name)
-        self.cnx.execute('CREATE INDEX %(index)s '
+        self.db._create_index(self.table, index,
+                    'CREATE INDEX %(index)s '
                     'ON %(table)s ( %(column)s )' % dict(
                     index=index,
                     table=self.table,
                     column=field_name))
+        self.db._schema_changed()
         
     def indices(self):
-        sql = "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='%s'" % self.table
-        return [row[0][len(self.table)+2:] for row in self.cnx.execute(sql)]
+        '''Return a list of all fields that have an index, including
+        those whose index creation is pending (see
+        DoqapyDatabase.bulk_load()).
+        '''
+        sql = ("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='%s' "
+               "UNION ALL SELECT name FROM _pending_indices WHERE tbl_name='%s'" % (self.table, self.table))
+        fields = (row[0][len(self.table)+2:] for row in self.cnx.execute(sql))
+        # Ignore indices of hidden columns
+        return [field for field in fields if field in self._fields]
             
         
     def _store_document(self, document, id, ref):
@@ -233,40 +1245,125 @@ class DoqapySqliteCollection(DoqapyCollection):
         All the necessary fields must have been created when this method
         is called.
         '''
-        columns = ['_id', '_ref']
-        values = [id, ref]
-        list_fields = []
-        list_values = []
-        for k, v in six.iteritems(document):
-            if k in ('_id', '_ref'):
-                continue
-            field_type = self._fields[k]
-            columns.append(k)
-            values.append(self._value_to_sql.get(field_type, lambda x: x)(v))
-            if isinstance(field_type[0], list):
-                list_fields.append(k)
-                item_field_type = (field_type[1],None)
-                list_values.append([self._value_to_sql.get(item_field_type, lambda x: x)(i) for i in v])
-                    
-        sql = 'INSERT INTO %(table)s (%(columns)s) VALUES (%(values)s)'\
-            % dict(table=self.table,
-                columns=', '.join(columns),
-                values=', '.join('?' for i in values))
-        self.cnx.execute(sql, values)
-        if list_fields:
-            list_index = cnx.execute('SELECT last_insert_rowid()').fetchone()[0]
-            for i in six.moves.range(len(list_fields)):
-                field = list_fields[i]
-                list_table = self.list_table % (self.table, field)
-                sql = ('INSERT INTO %s '
-                        '(list, i, value) '
-                        'VALUES (?, ?, ?)' % list_table)
-                values = [[list_index,j,list_values[i][j]] for j in six.moves.range(len(list_values[i]))]
-                cnx.executemany(sql, values)
+        self._store_documents(((document, id, ref),))
+
+    def _store_documents(self, documents):
+        '''Store several documents given as a sequence of (document, id,
+        ref). Rows having the same columns are inserted together with a
+        single executemany() call. Row ids are explicitly given in order
+        to fill the list tables without querying last_insert_rowid().
+        '''
+        rowid = self.cnx.execute('SELECT max(rowid) FROM %s' % self.table).fetchone()[0] or 0
+        encoders = self._encoders
+        hashed_lists = self._hashed_lists
+        list_hash_column = self._list_hash_column
+        list_equality = self.db.list_equality
+        ref_fields = refids = None
+        if self.db.integer_refs:
+            # Integer identifiers of all the references of the documents
+            # are created or read at once.
+            documents = list(documents)
+            ref_fields = set(field for field, field_type in six.iteritems(self._fields)
+                             if field_type in (ref_field_type, list_ref_field_type))
+            refs = []
+            for document, id, ref in documents:
+                refs.append(ref)
+                for k in ref_fields.intersection(document):
+                    v = document[k]
+                    if isinstance(v, list):
+                        refs.extend(v)
+                    elif v is not None:
+                        refs.append(v)
+            refids = self.db._ref_ids(refs)
+        rows = OrderedDict()
+        list_rows = OrderedDict()
+        for document, id, ref in documents:
+            rowid += 1
+            columns = ['rowid', '_id', '_ref']
+            values = [rowid, id, ref]
+            if refids is not None:
+                columns.append(self._refid_column % '_ref')
+                values.append(refids[ref])
+            for k in sorted(document):
+                if k in ('_id', '_ref'):
+                    continue
+                v = document[k]
+                columns.append(k)
+                if v is None:
+                    values.append(None)
+                    continue
+                to_sql, item_to_sql = encoders[k]
+                values.append(v if to_sql is None else to_sql(v))
+                if item_to_sql is not None:
+                    if k in hashed_lists:
+                        columns.append(list_hash_column % k)
+                        values.append(list_key(values[-1], list_equality)[0])
+                    if refids is not None and k in ref_fields:
+                        list_rows.setdefault(k, []).extend(
+                            (rowid, i, v[i], refids[v[i]]) for i in six.moves.range(len(v)))
+                    else:
+                        list_rows.setdefault(k, []).extend(
+                            (rowid, i, item_to_sql(v[i])) for i in six.moves.range(len(v)))
+                elif refids is not None and k in ref_fields:
+                    columns.append(self._refid_column % k)
+                    values.append(refids[v])
+            rows.setdefault(tuple(columns), []).append(values)
+
+        for columns, values in six.iteritems(rows):
+            sql = self._insert_sql.get(columns)
+            if sql is None:
+                sql = 'INSERT INTO %(table)s (%(columns)s) VALUES (%(values)s)'\
+                    % dict(table=self.table,
+                        columns=', '.join(columns),
+                        values=', '.join('?' for i in columns))
+                self._insert_sql[columns] = sql
+            self.cnx.executemany(sql, values)
+        for field, values in six.iteritems(list_rows):
+            list_table = self._list_table % (self.table, field)
+            if refids is not None and field in ref_fields:
+                self.cnx.executemany('INSERT INTO %s (list, i, value, refid) '
+                                     'VALUES (?, ?, ?, ?)' % list_table, values)
+            else:
+                self.cnx.executemany('INSERT INTO %s (list, i, value) '
+                                     'VALUES (?, ?, ?)' % list_table, values)
+    
+    def _documents_by_ref(self, cnx, refs):
+        '''Iterate over the (ref, document) pairs of the documents of the
+        collection whose reference is in refs. Documents are read from
+        cnx with one query per chunk of 500 references (below the
+        default maximum number of SQLite parameters).
+        '''
+        columns = list(self.fields)
+        identity = lambda x: x
+        decoders = [self._sql_to_value.get(self._fields[i], identity) for i in columns]
+        ref_index = columns.index('_ref')
+        for start in six.moves.range(0, len(refs), 500):
+            chunk = refs[start:start + 500]
+            sql = 'SELECT %s FROM %s WHERE _ref IN (%s)' % (','.join(columns), self.table,
+                                                             ', '.join('?' for ref in chunk))
+            for row in cnx.execute(sql, chunk):
+                yield row[ref_index], dict((columns[i], decoders[i](row[i]))
+                                           for i in six.moves.range(len(columns)) if row[i] is not None)
     
     def documents(self):
+        '''Iterate over the documents of the collection. Documents are
+        doqapy.row.Row mappings whose values are decoded on first access.
+        Fields with a NULL value are not in documents.
+        '''
         columns = list(self.fields)
+        decoders = [self._sql_to_value.get(self._fields[i]) for i in columns]
         sql = 'SELECT %s FROM %s' % (','.join(columns), self.table)
+        # Row schemas indexed by the positions of non NULL columns
+        schemas = {}
+        count = len(columns)
         for row in self.cnx.execute(sql):
-            yield dict((columns[i], row[i]) for i in six.moves.range(len(columns)) if row[i] is not None)
+            present = tuple(i for i in six.moves.range(count) if row[i] is not None)
+            schema = schemas.get(present)
+            if schema is None:
+                schema = schemas[present] = RowSchema([columns[i] for i in present],
+                                                      [decoders[i] for i in present])
+            if len(present) == count:
+                yield Row(schema, row)
+            else:
+                yield Row(schema, [row[i] for i in present])
             
\ No newline at end of file
@@ -3,14 +3,72 @@ from parsimonious.nodes import NodeVisitor
 from collections import OrderedDict
 import operator
 
+from doqapy import (
+    int_field_type,
+    float_field_type,
+    bool_field_type,
+    datetime_field_type,
+    date_field_type,
+    time_field_type,
+    list_ref_field_type,
+)
+from doqapy.codec import (
+    decode_datetime,
+    decode_date,
+    decode_time,
+)
+
+_numeric_field_types = (int_field_type, float_field_type, bool_field_type)
+
+# Type of "?" parameters compared to a list field: they are converted
+# to a (hash, list) pair of SQL values.
+list_key_parameter = 'list_key'
+
+# Functions used to parse string literals compared to temporal fields
+_parse_temporal_literal = {
+    datetime_field_type: decode_datetime,
+    date_field_type: decode_date,
+    time_field_type: decode_time,
+}
+
 class WhereVisitor(NodeVisitor):
+    # Errors due to the database state are not wrapped in a
+    # VisitationError
+    unwrapped_exceptions = (ValueError,)
+    
     def __init__(self, parser):
         self.db = parser.db
         self.columns = parser.columns
         self.from_tables = parser.from_tables
+        self.parameters = parser.parameters
+        self.predicates = parser.predicates
     
     def collection_to_table(self, collection):
         return self.db.get_collection(collection).table
+    
+    def field_operand(self, operand):
+        '''Convert a (collection, field) operand to SQL. Return the
+        SQL expression and the type of the field.
+        '''
+        collection, field = operand
+        if field is None:
+            field = '_ref'
+        collection_impl = self.db.get_collection(collection)
+        self.from_tables[collection_impl.table] = collection
+        if (collection, field) not in self.predicates:
+            self.predicates.append((collection, field))
+        return ('%s.%s' % (collection_impl.table, field),
+                collection_impl.fields.get(field))
+    
+    def temporal_literal(self, literal, field_type):
+        '''Convert a string literal compared to a temporal field to the
+        SQL representation of this field values.
+        '''
+        value = _parse_temporal_literal[field_type](literal[1:-1])
+        value = self.db._value_to_sql[field_type](value)
+        if isinstance(value, six.string_types):
+            return "'%s'" % value.replace("'", "''")
+        return str(value)
             
     def visit_where(self, n, vc):
         vc = [i for i in vc if i]
@@ -22,22 +80,90 @@ class WhereVisitor(NodeVisitor):
         for l in (left, right):
             if isinstance(left, tuple) and left[1] is None:
                 raise SyntaxError('Cannot use collection name %s with operator %s in %s. Expect a field name' % (l[0], op, n.text))
+        left_type = right_type = None
+        left_refid = right_refid = None
         if isinstance(left, tuple):
-            collection, field = left
-            if field is None:
-                field = '_ref'
-            tbl = self.collection_to_table(collection)
-            self.from_tables[tbl] = collection
-            left = '%s.%s' % (tbl, field)
+            left, left_type = self.field_operand(left)
+            left_refid = self.refid_column(left)
         if isinstance(right, tuple):
-            collection, field = right
-            if field is None:
-                field = '_ref'
-            tbl = self.collection_to_table(collection)
-            self.from_tables[tbl] = collection
-            right = '%s.%s' % (tbl, field)
+            right, right_type = self.field_operand(right)
+            right_refid = self.refid_column(right)
+        if op in ('=', '!=') and (self.is_list(left_type) or self.is_list(right_type)):
+            return self.list_equality(left, left_type, op, right, right_type, n)
+        if left_refid is not None and right_refid is not None:
+            # References are compared with their integer identifiers
+            return '%s %s %s' % (left_refid, op, right_refid)
+        # Parameters and literals are converted according to the type
+        # of the field they are compared to.
+        if left == '?':
+            self.parameters.append(right_type)
+        elif right_type in _parse_temporal_literal and left[0] == '"':
+            left = self.temporal_literal(left, right_type)
+        if right == '?':
+            self.parameters.append(left_type)
+        elif left_type in _parse_temporal_literal and right[0] == '"':
+            right = self.temporal_literal(right, left_type)
         return '%s %s %s' % (left, op, right)
       
+    @staticmethod
+    def is_list(field_type):
+        return field_type is not None and field_type[0] is list
+    
+    def list_equality(self, left, left_type, op, right, right_type, n):
+        '''Convert the comparison of a list field with another list
+        field or with a "?" parameter. The indexed hash columns of
+        list fields are compared first and the lists are then compared
+        according to the database list equality mode. Lists are simply
+        compared as text if a field has no hash column (i.e. in a
+        database that had not been upgraded to storage version 3).
+        '''
+        if not self.is_list(left_type):
+            left, left_type, right, right_type = right, right_type, left, left_type
+        left_hash = self.hash_column(left)
+        if right == '?':
+            if left_hash is None:
+                self.parameters.append(left_type)
+                return '%s %s ?' % (left, op)
+            self.parameters.append((list_key_parameter, left_type))
+            condition = '%s = ? AND %s = ?' % (left_hash, self.canonical_list(left))
+        elif self.is_list(right_type):
+            right_hash = self.hash_column(right)
+            if left_hash is None or right_hash is None:
+                return '%s %s %s' % (left, op, right)
+            condition = '%s = %s AND %s = %s' % (left_hash, right_hash,
+                                                 self.canonical_list(left), self.canonical_list(right))
+        else:
+            raise SyntaxError('A list field can only be compared to another list field or to "?": %s' % n.text)
+        if op == '=':
+            return '(%s)' % condition
+        return 'NOT (%s)' % condition
+    
+    def hash_column(self, column):
+        '''Return the hash column corresponding to a list field column
+        or None if the field has no hash column.
+        '''
+        table, field = column.split('.')
+        collection_impl = self.db.get_collection(self.from_tables[table])
+        if field not in collection_impl._hashed_lists:
+            return None
+        return '%s.%s' % (table, collection_impl._list_hash_column % field)
+    
+    def refid_column(self, column):
+        '''Return the column containing the integer identifiers of the
+        references of a field column or None if the field does not have
+        such a column (see integer_refs database option).
+        '''
+        table, field = column.split('.')
+        refid_column = self.db.get_collection(self.from_tables[table]).refid_column(field)
+        if refid_column is None:
+            return None
+        return '%s.%s' % (table, refid_column)
+    
+    def canonical_list(self, column):
+        if self.db.list_equality == 'set':
+            return 'doqapy_list_set(%s)' % column
+        return column
+    
     def visit_collection_field(self, n, vc):
         vc = [i for i in vc if i]
         if len(vc) == 3:
@@ -68,22 +194,37 @@ class WhereVisitor(NodeVisitor):
     def visit_in_operator(self, n, vc):
         vc = [i for i in vc if i]
         left, op, right = vc
+        left_refid = None
         if isinstance(left, tuple):
-            collection, field = left
-            if field is None:
-                field = '_ref'
-            table = self.collection_to_table(collection)
-            self.from_tables[table] = collection
-            left = '%s.%s' % (table, field)
+            left = self.field_operand(left)[0]
+            left_refid = self.refid_column(left)
             
         if isinstance(right, tuple):
             collection, field = right
-            table = self.collection_to_table(collection)
+            collection_impl = self.db.get_collection(collection)
+            table = collection_impl.table
             self.from_tables[table] = collection
             if field is None:
-                right = '(SELECT _ref FROM %s)' % table # TODO check interest of this
+                item_type = collection_impl.fields['_ref']
             else:
-                right = '(SELECT value FROM _{0}_list_{1} WHERE _{0}_list_{1}.list = {0}.rowid)'.format(table, field)
+                field_type = collection_impl.fields.get(field)
+                item_type = (None if field_type is None else (field_type[1], None))
+            if left == '?':
+                self.parameters.append(item_type)
+            elif item_type in _parse_temporal_literal and left[0] == '"':
+                left = self.temporal_literal(left, item_type)
+            if field is None:
+                if left_refid is not None:
+                    return '%s IN (SELECT %s FROM %s)' % (left_refid, collection_impl.refid_column('_ref'), table)
+                return '%s IN (SELECT _ref FROM %s)' % (left, table) # TODO check interest of this
+            # Documents whose list contains the value are selected with
+            # the (value, list) index of the list table.
+            self.db._check_list_tables()
+            list_table = collection_impl._list_table % (table, field)
+            if left_refid is not None and field_type == list_ref_field_type:
+                # The (refid, list) index is used for references
+                return '%s.rowid IN (SELECT list FROM %s WHERE refid = %s)' % (table, list_table, left_refid)
+            return '%s.rowid IN (SELECT list FROM %s WHERE value = %s)' % (table, list_table, left)
         else:
             if right == '?':
                 raise SyntaxError('Cannot use ? on the right of "in" operator: in expression "%s"' % n.text)
@@ -117,13 +258,27 @@ class ASTToSQLite(object):
         self.db = doqapy_db
         self.columns = OrderedDict()
         self.from_tables = OrderedDict()
+        # Types of the fields corresponding to "?" in query
+        self.parameters = []
+        # Sort keys as (SQL expression, descending) pairs
+        self.keys = []
+        # Number of sort keys added at the end of selected columns
+        self.hidden = 0
+        # Query variant used for keyset pagination
+        self.keyset = None
+        # Query variant restricted to a rowid range of the first table
+        # (used for parallel execution)
+        self.partition = None
+        self.aggregates = False
+        # (collection, field) pairs used in the where clause
+        self.predicates = []
     
     def collection_to_table(self, collection):
         return self.db.get_collection(collection).table
     
     def default_collection(self):
         if self.from_tables:
-            return six.itervalues(self.db.get_collection(self.from_tables).next())
+            return self.db.get_collection(next(six.itervalues(self.from_tables)))
         else:
             raise ValueError('Query does not allow to identify a default collecion')
     
@@ -141,11 +296,102 @@ class ASTToSQLite(object):
         else:
             self.parse_select(query)
             where = None
-        select = 'SELECT %s FROM %s' % (', '.join(self.columns), ', '.join(self.from_tables))
-        if where:
-            return '%s %s' % (select, where)
-        else:
-            return select
+        group_by, order_by, limit, offset = node.children[2:6]
+        tail = []
+        if group_by.children:
+            tail.append(self.parse_group_by(group_by.children[0]))
+        if order_by.children:
+            self.keys = self.parse_order_by(order_by.children[0])
+        # Position of keyset pagination parameters
+        seek_position = len(self.parameters)
+        if (self.keys or limit.children) and not (self.aggregates or group_by.children):
+            # Documents rowids are used as last sort keys in order to
+            # have a stable order allowing keyset pagination.
+            self.keys.extend(('%s.rowid' % table, False) for table in self.from_tables)
+            self.hidden = len(self.keys)
+        if self.keys:
+            tail.append('ORDER BY %s' % ', '.join(('%s DESC' % k if desc else k) for k, desc in self.keys))
+        # The offset is not used by keyset pagination since previous
+        # rows are skipped by the seek condition.
+        keyset_tail = list(tail)
+        offset_parameter = None
+        for clause in (limit, offset):
+            if clause.children:
+                value = clause.children[0].children[3].children[0].text
+                if value == '?':
+                    if clause is offset:
+                        offset_parameter = len(self.parameters)
+                    self.parameters.append(None)
+                sql = '%s %s' % (clause.children[0].children[1].text.upper(), value)
+                tail.append(sql)
+                if clause is limit:
+                    keyset_tail.append(sql)
+        
+        columns = list(self.columns)
+        if len(self.from_tables) == 1:
+            # Documents can be counted without DISTINCT on a single table
+            count = 'COUNT(DISTINCT %s.rowid)' % next(iter(self.from_tables))
+            columns = [i.replace(count, 'COUNT(*)') for i in columns]
+        if self.hidden:
+            columns.extend(k for k, desc in self.keys)
+        select = 'SELECT %s FROM %s' % (', '.join(columns), ', '.join(self.from_tables))
+        if self.hidden:
+            seek, seek_parameters = self.seek_condition()
+            if where:
+                seek = 'WHERE (%s) AND (%s)' % (where[len('WHERE '):], seek)
+            else:
+                seek = 'WHERE %s' % seek
+            self.keyset = {
+                'sql': ' '.join([select, seek] + keyset_tail),
+                'position': seek_position,
+                'parameters': seek_parameters,
+                'skip': (() if offset_parameter is None else (offset_parameter,)),
+            }
+        if not (tail or self.aggregates):
+            # Rows of unsorted and unlimited queries can be computed
+            # independently for several ranges of documents.
+            table = next(iter(self.from_tables))
+            condition = '%s.rowid BETWEEN ? AND ?' % table
+            if where:
+                condition = 'WHERE (%s) AND %s' % (where[len('WHERE '):], condition)
+            else:
+                condition = 'WHERE %s' % condition
+            self.partition = {
+                'sql': '%s %s' % (select, condition),
+                'table': table,
+            }
+        return ' '.join([select] + ([where] if where else []) + tail)
+    
+    def seek_condition(self):
+        '''Return the SQL condition selecting rows located after a given
+        row in the order defined by self.keys and the indices of the key
+        values to use as parameters of this condition.
+        '''
+        directions = set(desc for k, desc in self.keys)
+        if len(directions) == 1:
+            # Row values comparison can use indices
+            op = ('<' if directions.pop() else '>')
+            return ('(%s) %s (%s)' % (', '.join(k for k, desc in self.keys), op,
+                                      ', '.join('?' for k in self.keys)),
+                    list(six.moves.range(len(self.keys))))
+        terms = []
+        parameters = []
+        for i, (key, desc) in enumerate(self.keys):
+            term = ['%s = ?' % k for k, d in self.keys[:i]]
+            term.append('%s %s ?' % (key, ('<' if desc else '>')))
+            terms.append('(%s)' % ' AND '.join(term))
+            parameters.extend(six.moves.range(i + 1))
+        return ' OR '.join(terms), parameters
+    
+    def parse_order_by(self, node):
+        items = [node.children[5]] + [i.children[3] for i in node.children[6].children]
+        keys = []
+        for order_item in items:
+            collection_field, direction = order_item.children
+            collection, field = self.parse_collection_field(collection_field)
+            desc = bool(direction.children) and direction.text.strip().lower() == 'desc'
+            keys.append(('%s.%s' % (collection.table, field), desc))
+        return keys
             
     def parse_select(self, node):
         self.parse_select_item(node.children[2])
@@ -161,21 +407,121 @@ class ASTToSQLite(object):
             for field in collection.fields:
                 self.columns['%s.%s' % (collection_table, field)] = ('%s.%s' % (collection.collection, field),
                                                                      collection.fields[field])
+        elif node.expr_name == 'aggregate_item':
+            aggregate, alias = node.children
+            column, name, field_type = self.parse_aggregate(aggregate)
+            if alias.children:
+                name = alias.children[0].children[3].text
+                column = '%s AS %s' % (column, name)
+            self.columns[column] = (name, field_type)
         else:
             collection_field, alias = node.children
-            collection = collection_field.children[0].text
-            if not collection:
-                collection = self.default_collection()
-            else:
-                collection = self.db.get_collection(collection)
-                self.from_tables[collection.table] = collection.collection
-            field = collection_field.children[2].text
+            collection, field = self.parse_collection_field(collection_field)
             if alias.children:
                 alias = alias.children[0].children[3].text
                 self.columns['%s.%s AS %s' % (collection.table, field, alias)] = (alias,collection.fields[field])
             else:
                 self.columns['%s.%s' % (collection.table, field)] = ('%s.%s' % (collection.collection, field),
                                                                      collection.fields[field])
+    
+    def parse_collection_field(self, node):
+        '''Return the collection and the field name corresponding to a
+        collection_field node. The collection is added to the tables
+        used in the query.
+        '''
+        collection = node.children[0].text
+        if not collection:
+            collection = self.default_collection()
+        else:
+            collection = self.db.get_collection(collection)
+            self.from_tables[collection.table] = collection.collection
+        return collection, node.children[2].text
+    
+    def parse_aggregate(self, node):
+        '''Return the SQL expression, the default name and the type of
+        an aggregate function.
+        '''
+        function = node.children[0].text.lower()
+        self.aggregates = True
+        argument = node.children[4].children[0]
+        name = '%s(%s)' % (function, argument.text)
+        if argument.expr_name == 'collection_path':
+            if function != 'count':
+                raise SyntaxError('Function %s requires a field name: %s' % (function, node.text))
+            collection = self.db.get_collection(argument.text)
+            self.from_tables[collection.table] = collection.collection
+            # Count documents of the collection and not combinations of
+            # documents of all the tables in the query
+            return ('COUNT(DISTINCT %s.rowid)' % collection.table, name, int_field_type)
+        collection, field = self.parse_collection_field(argument)
+        field_type = collection.fields[field]
+        column = '%s.%s' % (collection.table, field)
+        if function == 'count':
+            return ('COUNT(%s)' % column, name, int_field_type)
+        if function in ('min', 'max'):
+            return ('%s(%s)' % (function.upper(), column), name, field_type)
+        if field_type not in _numeric_field_types:
+            raise SyntaxError('Function %s requires a numeric field: %s' % (function, node.text))
+        if function == 'sum':
+            if field_type is float_field_type:
+                return ('TOTAL(%s)' % column, name, float_field_type)
+            return ('SUM(%s)' % column, name, int_field_type)
+        return ('AVG(%s)' % column, name, float_field_type)
+    
+    def parse_group_by(self, node):
+        columns = [node.children[5]] + [i.children[3] for i in node.children[6].children]
+        group_by = []
+        for collection_field in columns:
+            collection, field = self.parse_collection_field(collection_field)
+            group_by.append('%s.%s' % (collection.table, field))
+        return 'GROUP BY %s' % ', '.join(group_by)
 
     def parse_where(self, node):
         return WhereVisitor(self).visit(node)
+    
+    def parse_distinct(self, field_name, node, counts):
+        '''Return the SQL selecting the distinct values of a field
+        (given as "<collection>.<field>") for documents matching the
+        "where" clause contained in node (or all documents if node is
+        None). Values of list fields are read from the list table in
+        order to get individual items. If counts is True, the number of
+        documents is selected with each value.
+        '''
+        collection, field = field_name.rsplit('.', 1)
+        collection = self.db.get_collection(collection)
+        field_type = collection.fields[field]
+        self.from_tables[collection.table] = collection.collection
+        conditions = []
+        if node is not None:
+            conditions.append('(%s)' % self.parse_where(node)[len('WHERE '):])
+        tables = list(self.from_tables)
+        if field_type[0] is list:
+            self.db._check_list_tables()
+            list_table = collection._list_table % (collection.table, field)
+            column = '%s.value' % list_table
+            self.columns[column] = (field_name, (field_type[1], None))
+            if conditions:
+                tables.append(list_table)
+                conditions.insert(0, '%s.list = %s.rowid' % (list_table, collection.table))
+            else:
+                # Documents table is not necessary
+                tables = [list_table]
+            document = '%s.list' % list_table
+        else:
+            column = '%s.%s' % (collection.table, field)
+            self.columns[column] = (field_name, field_type)
+            document = '%s.rowid' % collection.table
+        if counts:
+            if len(tables) == 1 and field_type[0] is not list:
+                count = 'COUNT(*)'
+            else:
+                count = 'COUNT(DISTINCT %s)' % document
+            self.columns[count] = ('count', int_field_type)
+            sql = 'SELECT %s, %s FROM %s' % (column, count, ', '.join(tables))
+        else:
+            sql = 'SELECT DISTINCT %s FROM %s' % (column, ', '.join(tables))
+        if conditions:
+            sql = '%s WHERE %s' % (sql, ' AND '.join(conditions))
+        if counts:
+            sql = '%s GROUP BY %s' % (sql, column)
+        return sql
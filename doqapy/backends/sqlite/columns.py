@@ -0,0 +1,132 @@
+'''
+Columnar (NumPy) results for SQLite queries. This module requires NumPy.
+'''
+
+import numpy
+
+from doqapy import (
+    int_field_type,
+    float_field_type,
+    bool_field_type,
+    datetime_field_type,
+    date_field_type,
+    time_field_type,
+)
+from doqapy.codec import (
+    decode_datetime,
+    decode_date,
+    decode_time,
+    encode_epoch_datetime,
+    encode_epoch_time,
+)
+
+# Ordinal of 1970-01-01, the origin of numpy.datetime64
+_epoch_ordinal = 719163
+
+_nat = numpy.iinfo(numpy.int64).min
+
+_numeric_dtypes = {
+    int_field_type: numpy.int64,
+    float_field_type: numpy.float64,
+    bool_field_type: numpy.bool_,
+}
+
+_temporal_dtypes = {
+    datetime_field_type: 'datetime64[us]',
+    date_field_type: 'datetime64[D]',
+    time_field_type: 'timedelta64[us]',
+}
+
+# Functions converting SQL values of temporal fields to the integer
+# stored in a numpy.datetime64 or numpy.timedelta64.
+_temporal_to_int = {
+    'iso': {
+        datetime_field_type: lambda x: encode_epoch_datetime(decode_datetime(x)),
+        date_field_type: lambda x: decode_date(x).toordinal() - _epoch_ordinal,
+        time_field_type: lambda x: encode_epoch_time(decode_time(x)),
+    },
+    'epoch': {
+        datetime_field_type: None,
+        date_field_type: lambda x: x - _epoch_ordinal,
+        time_field_type: None,
+    },
+}
+
+
+class ColumnBuilder(object):
+    '''Accumulate the values of a column in a preallocated buffer that
+    grows when necessary. NULL values of integer and boolean columns are
+    recorded in a mask.
+    '''
+    def __init__(self, field_type, decoder, temporal_storage, capacity):
+        self.size = 0
+        self.mask = None
+        self.view = None
+        self.convert = None
+        dtype = _numeric_dtypes.get(field_type)
+        if dtype is not None:
+            self.masked = (dtype is not numpy.float64)
+        elif field_type in _temporal_dtypes:
+            # Temporal values are accumulated as integers with NaT for
+            # NULL values
+            dtype = numpy.int64
+            self.masked = False
+            self.view = _temporal_dtypes[field_type]
+            to_int = _temporal_to_int[temporal_storage][field_type]
+            if to_int is None:
+                self.convert = lambda values: [(_nat if i is None else i) for i in values]
+            else:
+                self.convert = lambda values: [(_nat if i is None else to_int(i)) for i in values]
+        else:
+            dtype = object
+            self.masked = False
+            if decoder is not None:
+                self.convert = lambda values: [decoder(i) for i in values]
+        self.buffer = numpy.empty(capacity, dtype=dtype)
+
+    def append(self, values):
+        if self.convert is not None:
+            values = self.convert(values)
+        count = len(values)
+        end = self.size + count
+        if end > len(self.buffer):
+            capacity = max(end, 2 * len(self.buffer))
+            self.buffer = numpy.resize(self.buffer, capacity)
+            if self.mask is not None:
+                self.mask = numpy.resize(self.mask, capacity)
+        if self.masked and (self.mask is not None or None in values):
+            if self.mask is None:
+                self.mask = numpy.zeros(len(self.buffer), dtype=numpy.bool_)
+            self.mask[self.size:end] = [i is None for i in values]
+            values = [(0 if i is None else i) for i in values]
+        if self.buffer.dtype == object:
+            # Assigning a sequence of lists to a slice would be
+            # interpreted as a 2D array
+            for i, value in enumerate(values, self.size):
+                self.buffer[i] = value
+        else:
+            self.buffer[self.size:end] = values
+        self.size = end
+
+    def array(self):
+        result = self.buffer[:self.size]
+        if self.view is not None:
+            result = result.view(self.view)
+        if self.mask is not None:
+            result = numpy.ma.MaskedArray(result, mask=self.mask[:self.size])
+        return result
+
+
+def fetch_columns(cursor, fields, decoders, temporal_storage, batch_size):
+    '''Read all the rows of a cursor by batches of batch_size rows and
+    return a list with one array per column.
+    '''
+    builders = [ColumnBuilder(field_type, decoder, temporal_storage, batch_size)
+                for (name, field_type), decoder in zip(fields, decoders)]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for builder, values in zip(builders, zip(*rows)):
+            builder.append(values)
+    return [builder.array() for builder in builders]
@@ -0,0 +1,46 @@
+'''
+Keys used to compare lists and SQL functions registered on connections
+'''
+
+import hashlib
+import json
+import struct
+
+from doqapy.codec import encode_list
+
+# Modes of list equality
+list_equality_modes = ('ordered', 'set')
+
+
+def canonical_set(text):
+    '''Return the canonical representation of the set of items of a
+    list stored as JSON text (i.e. its distinct items sorted).
+    '''
+    if text is None:
+        return None
+    return encode_list(sorted(set(json.loads(text))))
+
+
+def list_hash(text):
+    '''Return a signed 64 bits integer computed from the text
+    representation of a list.
+    '''
+    if text is None:
+        return None
+    return struct.unpack('>q', hashlib.md5(text.encode('utf8')).digest()[:8])[0]
+
+
+def list_key(text, list_equality):
+    '''Return the (hash, text) pair used to compare a list stored as
+    JSON text to other lists.
+    '''
+    if list_equality == 'set':
+        text = canonical_set(text)
+    return list_hash(text), text
+
+
+def register_functions(cnx):
+    '''Register the SQL functions used by compiled queries on a SQLite
+    connection.
+    '''
+    cnx.create_function('doqapy_list_set', 1, canonical_set)
@@ -0,0 +1,70 @@
+'''
+Parallel execution of SQLite queries in worker processes
+'''
+
+import multiprocessing
+import sqlite3
+
+from doqapy.row import Row, RowSchema
+from .functions import register_functions
+from .result import DoqapySqliteResult
+
+# Read-only connections of a worker process indexed by database name
+_connections = {}
+
+
+def _connection(sqlite_database):
+    cnx = _connections.get(sqlite_database)
+    if cnx is None:
+        cnx = sqlite3.connect(sqlite_database)
+        register_functions(cnx)
+        cnx.execute('PRAGMA query_only = ON')
+        cnx.execute('PRAGMA cache_size = 8192')
+        _connections[sqlite_database] = cnx
+    return cnx
+
+
+def _scan_partition(task):
+    '''Worker function selecting and decoding the rows of a range of
+    documents. Arguments are given in a single picklable tuple.
+    '''
+    sqlite_database, temporal_storage, sql, parameters, field_types = task
+    # Avoid circular import
+    from .api import DoqapySqliteCollection
+
+    sql_to_value = DoqapySqliteCollection.conversions(temporal_storage)[2]
+    decode = DoqapySqliteResult._row_decoder([sql_to_value.get(i) for i in field_types])
+    rows = _connection(sqlite_database).execute(sql, parameters).fetchall()
+    if decode is not None:
+        rows = [decode(row) for row in rows]
+    return rows
+
+
+def parallel_rows(sqlite_database, temporal_storage, sql, parameters, ranges, fields,
+                  processes, ordered=False, values_only=False):
+    '''Generator executing sql (whose two last parameters are the bounds
+    of a rowid range) for each range in a pool of processes and yielding
+    the resulting rows. The pool is terminated when the generator is
+    exhausted or closed.
+    '''
+    field_types = [i[1] for i in fields]
+    schema = RowSchema(i[0] for i in fields)
+    tasks = [(sqlite_database, temporal_storage, sql, list(parameters) + [first, last], field_types)
+             for first, last in ranges]
+    if not tasks:
+        return
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        if ordered:
+            results = pool.imap(_scan_partition, tasks)
+        else:
+            results = pool.imap_unordered(_scan_partition, tasks)
+        for rows in results:
+            if values_only:
+                for row in rows:
+                    yield row
+            else:
+                for row in rows:
+                    yield Row(schema, row)
+    finally:
+        pool.terminate()
@@ -0,0 +1,88 @@
+'''
+Pool of read-only SQLite connections
+'''
+
+import sqlite3
+import threading
+
+import six
+
+from .functions import register_functions
+
+
+class ConnectionPool(object):
+    '''Pool of at most size read-only connections to a SQLite database.
+    Connections are created on demand. acquire() blocks when all the
+    connections are in use by other threads. A thread that already
+    holds a connection (e.g. to read the rows of a query while executing
+    other queries) gets the same connection again ; it is given back to
+    the pool when it has been released as many times as it had been
+    acquired. With a database in WAL mode, each reader sees a consistent
+    snapshot of committed data and is not blocked by the writer
+    connection.
+    '''
+    def __init__(self, sqlite_database, size):
+        self.sqlite_database = sqlite_database
+        self.size = size
+        self._idle = six.moves.queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # [connection, count] of the connections held by each thread
+        # indexed by thread identifier. The identifier of the holding
+        # thread is also indexed by connection because results may be
+        # released by another thread.
+        self._held = {}
+        self._holders = {}
+
+    def _connect(self):
+        cnx = sqlite3.connect(self.sqlite_database, check_same_thread=False)
+        register_functions(cnx)
+        cnx.execute('PRAGMA query_only = ON')
+        cnx.execute('PRAGMA cache_size = 8192')
+        return cnx
+
+    def acquire(self):
+        '''Return a connection that must be given back with release().'''
+        thread = threading.current_thread().ident
+        with self._lock:
+            held = self._held.get(thread)
+            if held is not None:
+                held[1] += 1
+                return held[0]
+        try:
+            cnx = self._idle.get_nowait()
+        except six.moves.queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                cnx = self._connect()
+            else:
+                cnx = self._idle.get()
+        with self._lock:
+            self._held[thread] = [cnx, 1]
+            self._holders[cnx] = thread
+        return cnx
+
+    def release(self, cnx):
+        with self._lock:
+            thread = self._holders[cnx]
+            held = self._held[thread]
+            held[1] -= 1
+            if held[1]:
+                return
+            del self._held[thread]
+            del self._holders[cnx]
+        self._idle.put(cnx)
+
+    def close(self):
+        '''Close idle connections.'''
+        while True:
+            try:
+                cnx = self._idle.get_nowait()
+            except six.moves.queue.Empty:
+                break
+            cnx.close()
+            with self._lock:
+                self._created -= 1
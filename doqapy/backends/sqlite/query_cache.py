@@ -0,0 +1,50 @@
+'''
+LRU cache for compiled Doqapy queries
+'''
+
+import threading
+from collections import OrderedDict, namedtuple
+
+QueryCacheInfo = namedtuple('QueryCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class QueryCache(object):
+    '''Least recently used cache of compiled queries. Keys must be
+    hashable and should identify both the query text and the schema it
+    had been compiled for. A maxsize of 0 disables the cache.
+    '''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Return the value cached for key or None.'''
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                # Mark key as the most recently used
+                del self._cache[key]
+                self._cache[key] = value
+            return value
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = value
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def info(self):
+        return QueryCacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
@@ -0,0 +1,36 @@
+'''
+Statistics on the fields used to filter or join documents in queries
+'''
+
+import threading
+from collections import Counter
+
+
+class QueryLog(object):
+    '''Count, for each (collection, field) pair, the number of executed
+    queries using the field in their where clause. It is thread-safe.
+    '''
+    def __init__(self):
+        self.queries = 0
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, predicates):
+        '''Record the execution of a query using the given (collection,
+        field) pairs.
+        '''
+        with self._lock:
+            self.queries += 1
+            self._counts.update(predicates)
+
+    def counts(self):
+        '''Return a list of ((collection, field), count) sorted by
+        decreasing count.
+        '''
+        with self._lock:
+            return self._counts.most_common()
+
+    def clear(self):
+        with self._lock:
+            self.queries = 0
+            self._counts.clear()
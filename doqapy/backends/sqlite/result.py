@@ -0,0 +1,156 @@
+'''
+Streaming of SQLite query results
+'''
+
+import base64
+import json
+
+from doqapy.row import Row, RowSchema
+from doqapy.stats import clock
+
+
+def encode_continuation(keys):
+    '''Return a continuation token containing the sort keys of a row.'''
+    return base64.urlsafe_b64encode(json.dumps(list(keys)).encode('utf8')).decode('ascii')
+
+
+def decode_continuation(token):
+    '''Return the sort keys contained in a continuation token.'''
+    return json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf8'))
+
+
+class DoqapySqliteResult(object):
+    '''Iterable over the result of a query. Rows are read from the
+    SQLite cursor by batches of batch_size rows and are converted with
+    a row decoder built once per query. If values_only is True, rows are
+    tuples otherwise they are Row instances that decode each value on
+    first access. The last hidden columns of
+    SQL rows contain sort keys ; they are not returned but are used to
+    build a continuation token. If not None, release is called when the
+    result is closed, either explicitly or after having read all rows.
+    If not None, event is an instrumentation event dictionary (see
+    doqapy.stats) completed with fetch and decode times and given to emit
+    when the result is closed. If not None, resolve is called with the
+    SQLite connection and each batch of decoded rows and returns the
+    rows with resolved references.
+    '''
+    def __init__(self, cursor, names, decoders, values_only=False, batch_size=1000, hidden=0,
+                 release=None, event=None, emit=None, resolve=None):
+        self.cursor = cursor
+        self._release = release
+        self._event = event
+        self._emit = emit
+        self._resolve = resolve
+        self.values_only = values_only
+        self.batch_size = batch_size
+        self.hidden = hidden
+        if values_only or resolve is not None:
+            # Values are needed to build tuples or to resolve references
+            self.schema = RowSchema(names)
+            self._decode = self._row_decoder(decoders)
+        else:
+            self.schema = RowSchema(names, decoders)
+            self._decode = None
+        self._last_keys = None
+
+    @staticmethod
+    def _row_decoder(decoders):
+        '''Return a function converting a SQLite row to a tuple of
+        Python values. Columns without decoder are not processed.
+        '''
+        converters = [(i, decoder) for i, decoder in enumerate(decoders) if decoder is not None]
+        if not converters:
+            return None
+
+        def decode(row):
+            row = list(row)
+            for i, decoder in converters:
+                row[i] = decoder(row[i])
+            return tuple(row)
+        return decode
+
+    def _fetch(self, size):
+        '''Return the next rows of the result and the list of their sort
+        keys (None if there are no hidden columns).
+        '''
+        if self.cursor is None:
+            return [], None
+        event = self._event
+        if event is not None:
+            start = clock()
+        rows = self.cursor.fetchmany(size or self.batch_size)
+        if event is not None:
+            fetched = clock()
+            event['fetch_time'] += fetched - start
+            event['rows'] += len(rows)
+        if not rows:
+            self.close()
+        keys = None
+        if self.hidden and rows:
+            keys = [row[-self.hidden:] for row in rows]
+            rows = [row[:-self.hidden] for row in rows]
+        if self._decode is not None:
+            rows = [self._decode(row) for row in rows]
+        if self._resolve is not None and rows:
+            rows = self._resolve(self.cursor.connection, rows)
+        if not self.values_only:
+            schema = self.schema
+            rows = [Row(schema, row) for row in rows]
+        if event is not None:
+            event['decode_time'] += clock() - fetched
+        return rows, keys
+
+    def fetchmany(self, size=None):
+        '''Return a list with the next rows of the result. An empty list
+        is returned when all rows have been read.
+        '''
+        rows, keys = self._fetch(size)
+        if keys:
+            self._last_keys = keys[-1]
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows, keys = self._fetch(None)
+            if not rows:
+                break
+            if keys:
+                for row, self._last_keys in zip(rows, keys):
+                    yield row
+            else:
+                for row in rows:
+                    yield row
+
+    def continuation(self):
+        '''Return a token that can be given to execute() (with the same
+        query and parameters) in order to get the rows following the
+        last row read from this result. Return None if no row had been
+        read or if the query does not have sort keys.
+        '''
+        if self._last_keys is None:
+            return None
+        return encode_continuation(self._last_keys)
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+            if self._release is not None:
+                self._release()
+                self._release = None
+            event = self._event
+            if event is not None:
+                self._event = None
+                event['time'] = (event['parse_time'] + event['compile_time'] +
+                                 event['execute_time'] + event['fetch_time'] +
+                                 event['decode_time'])
+                self._emit(event)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,63 @@
+from __future__ import print_function
+
+if __name__ == '__main__':
+    import six
+    import os
+    import os.path as osp
+    import time
+    from random import random
+    from doqapy import connect
+
+    db_file = '/tmp/benchmark.sqlite'
+    number_of_documents = 20000
+    number_of_files_per_acquisition = 4
+    number_of_measures_per_acquisition = 4
+
+    def acquisitions():
+        for i in six.moves.range(number_of_documents):
+            acquisition = dict(
+                type = 'acquisition%06d' % i,
+                concerns = ['study/%03d' % (i % 10), 'subject/%06d' % i],
+            )
+            for l in six.moves.range(number_of_files_per_acquisition):
+                acquisition['file_%02d' % l] = '/%06d/acquisition_%02d.format' % (i, l)
+            for l in six.moves.range(number_of_measures_per_acquisition):
+                acquisition['aquisition_measure_%02d' % l] = random() * 100
+            yield acquisition
+
+    def open_database():
+        if osp.exists(db_file):
+            os.remove(db_file)
+        return connect('sqlite:%s' % db_file)
+
+    doqapy = open_database()
+    start = time.time()
+    for document in acquisitions():
+        doqapy.store_document(document, collection='acquisition')
+    doqapy.commit()
+    duration = time.time() - start
+    print('store_document: %d documents in %.2fs (%d documents/s)' % (number_of_documents, duration, number_of_documents / duration))
+
+    doqapy = open_database()
+    start = time.time()
+    doqapy.store_documents(acquisitions(), collection='acquisition')
+    doqapy.commit()
+    duration = time.time() - start
+    print('store_documents: %d documents in %.2fs (%d documents/s)' % (number_of_documents, duration, number_of_documents / duration))
+
+    number_of_values = 1000000
+    import datetime
+    import dateutil.parser
+    from doqapy.codec import decode_datetime
+    now = datetime.datetime.now()
+    values = [(now + datetime.timedelta(seconds=i)).isoformat() for i in six.moves.range(number_of_values)]
+    start = time.time()
+    for value in values:
+        decode_datetime(value)
+    duration = time.time() - start
+    print('decode_datetime: %d values in %.2fs (%d values/s)' % (number_of_values, duration, number_of_values / duration))
+    start = time.time()
+    for value in values:
+        dateutil.parser.parse(value)
+    duration = time.time() - start
+    print('dateutil.parser.parse: %d values in %.2fs (%d values/s)' % (number_of_values, duration, number_of_values / duration))
@@ -0,0 +1,143 @@
+'''
+Conversion of Doqapy values to and from their storage representation.
+
+Temporal values written by Doqapy use isoformat() and are decoded with
+the strict (and fast) fromisoformat() methods. dateutil is only used for
+values that are not in this format (e.g. values coming from other
+software).
+
+Temporal values can also be stored as integers that sort like the values
+they represent : datetimes are microseconds since 1970-01-01 UTC, dates
+are proleptic Gregorian ordinals and times are microseconds since
+midnight. Timezone aware values are converted to UTC and decoded values
+are naive.
+
+Lists are stored as JSON arrays. Older databases stored lists as the
+repr() of their items joined with tabulations ; these values never start
+with "[" and are still decoded (without using eval()).
+'''
+
+import ast
+import datetime
+import json
+
+import dateutil.parser
+
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+_json_decode = json.JSONDecoder().decode
+
+# fromisoformat() methods exist since Python 3.7. When they are None,
+# calling them raises a TypeError and dateutil is used.
+_datetime_fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
+_date_fromisoformat = getattr(datetime.date, 'fromisoformat', None)
+_time_fromisoformat = getattr(datetime.time, 'fromisoformat', None)
+
+
+def decode_datetime(text):
+    '''Return the datetime.datetime corresponding to a text.'''
+    try:
+        return _datetime_fromisoformat(text)
+    except (TypeError, ValueError):
+        return dateutil.parser.parse(text)
+
+
+def decode_date(text):
+    '''Return the datetime.date corresponding to a text.'''
+    try:
+        return _date_fromisoformat(text)
+    except (TypeError, ValueError):
+        return dateutil.parser.parse(text).date()
+
+
+def decode_time(text):
+    '''Return the datetime.time corresponding to a text.'''
+    try:
+        return _time_fromisoformat(text)
+    except (TypeError, ValueError):
+        return dateutil.parser.parse(text).time()
+
+
+_epoch = datetime.datetime(1970, 1, 1)
+_microseconds_per_day = 86400000000
+
+
+def encode_epoch_datetime(value):
+    '''Return the number of microseconds between 1970-01-01 UTC and a
+    datetime.datetime.
+    '''
+    offset = value.utcoffset()
+    if offset is not None:
+        value = value.replace(tzinfo=None) - offset
+    delta = value - _epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def decode_epoch_datetime(value):
+    '''Return the naive UTC datetime.datetime corresponding to a
+    number of microseconds since 1970-01-01 UTC.
+    '''
+    return _epoch + datetime.timedelta(microseconds=value)
+
+
+def encode_epoch_date(value):
+    '''Return the proleptic Gregorian ordinal of a datetime.date.'''
+    return value.toordinal()
+
+
+def decode_epoch_date(value):
+    '''Return the datetime.date corresponding to a proleptic Gregorian
+    ordinal.
+    '''
+    return datetime.date.fromordinal(value)
+
+
+def encode_epoch_time(value):
+    '''Return the number of microseconds between midnight UTC and a
+    datetime.time.
+    '''
+    result = ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond
+    offset = value.utcoffset()
+    if offset is not None:
+        result = (result - (offset.days * 86400 + offset.seconds) * 1000000) % _microseconds_per_day
+    return result
+
+
+def decode_epoch_time(value):
+    '''Return the naive datetime.time corresponding to a number of
+    microseconds since midnight.
+    '''
+    seconds, microsecond = divmod(value, 1000000)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return datetime.time(hour, minute, second, microsecond)
+
+
+def encode_list(values):
+    '''Return the JSON representation of a list of strings, numbers or
+    booleans.
+    '''
+    return _json_encoder.encode(values)
+
+
+def decode_list(text):
+    '''Return the list of values contained in a JSON array or in a list
+    using the legacy tab separated repr() format (where an empty list
+    is an empty string).
+    '''
+    if text[:1] == '[':
+        return _json_decode(text)
+    if not text:
+        return []
+    return [ast.literal_eval(i) for i in text.split('\t')]
+
+
+def decode_text_list(text):
+    '''Same as decode_list() but for lists whose items where stored
+    without repr() in the legacy format (e.g. isoformat() of temporal
+    values).
+    '''
+    if text[:1] == '[':
+        return _json_decode(text)
+    if not text:
+        return []
+    return text.split('\t')
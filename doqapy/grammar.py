@@ -1,11 +1,16 @@
 from parsimonious.grammar import Grammar
 
 grammar = Grammar('''
-query = _? ( select_where / select / where ) _?
+query = _? ( select_where / select / where ) group_by? order_by? limit? offset? _?
 select_where = select _ where
 _ = ~"[ \\n\\t]+"
 select = ~"select"i _ select_item (_? "," _? select_item)*
-select_item = (collection_field (_ "as" _ identifier)?) / collection_path
+select_item = aggregate_item / field_item / collection_path
+field_item = collection_field alias?
+aggregate_item = aggregate alias?
+alias = _ ~"as"i _ identifier
+aggregate = aggregate_function _? "(" _? (collection_field / collection_path) _? ")"
+aggregate_function = ~"count"i / ~"min"i / ~"max"i / ~"sum"i / ~"avg"i
 identifier = ~"[a-zA-Z_][a-zA-Z0-9_]*"
 collection_path = identifier ("/" identifier)*
 collection_field = (collection_path)? "." identifier
@@ -28,4 +33,11 @@ parenthesis_bool = "(" _? boolean_expression _? ")"
 operator_bool = and_bool / or_bool
 and_bool = _ ~"and"i _ boolean_expression
 or_bool = _ ~"or"i _ boolean_expression
+
+group_by = _ ~"group"i _ ~"by"i _ collection_field (_? "," _? collection_field)*
+order_by = _ ~"order"i _ ~"by"i _ order_item (_? "," _? order_item)*
+order_item = collection_field order_direction?
+order_direction = _ (~"asc"i / ~"desc"i)
+limit = _ ~"limit"i _ (number / external_data)
+offset = _ ~"offset"i _ (number / external_data)
 ''')
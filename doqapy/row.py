@@ -0,0 +1,76 @@
+'''
+Lightweight read-only documents returned by queries
+'''
+
+from six.moves import collections_abc
+
+
+class RowSchema(object):
+    '''Column names shared by all the rows of a query result. If not
+    None, decoders contains, for each column, the function converting
+    the stored value to a Python value (or None if no conversion is
+    necessary).
+    '''
+    __slots__ = ('names', 'index', 'decoders')
+
+    def __init__(self, names, decoders=None):
+        self.names = tuple(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        if decoders is not None:
+            decoders = tuple(decoders)
+            if not any(decoders):
+                decoders = None
+        self.decoders = decoders
+
+
+class Row(collections_abc.Mapping):
+    '''A query result row. It is a read-only mapping whose keys are the
+    column names of the query and values are stored in a sequence. The
+    column names are not duplicated in each row but shared in a
+    RowSchema. If the schema has decoders, values are stored as read
+    from the database and are decoded on first access ; decoded values
+    are kept in a dictionary allocated with the first decoding.
+    '''
+    __slots__ = ('_schema', '_values', '_decoded')
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+        self._decoded = None
+
+    def _value(self, i):
+        decoders = self._schema.decoders
+        if decoders is None or decoders[i] is None:
+            return self._values[i]
+        decoded = self._decoded
+        if decoded is None:
+            decoded = self._decoded = {}
+        elif i in decoded:
+            return decoded[i]
+        value = decoded[i] = decoders[i](self._values[i])
+        return value
+
+    def __getitem__(self, key):
+        return self._value(self._schema.index[key])
+
+    def __iter__(self):
+        return iter(self._schema.names)
+
+    def __len__(self):
+        return len(self._schema.names)
+
+    def __contains__(self, key):
+        return key in self._schema.index
+
+    def as_tuple(self):
+        '''Return the values of the row in column order.'''
+        if self._schema.decoders is None:
+            return tuple(self._values)
+        return tuple(self._value(i) for i in range(len(self._values)))
+
+    def as_dict(self):
+        '''Return a new dictionary with the content of the row.'''
+        return dict(zip(self._schema.names, self.as_tuple()))
+
+    def __repr__(self):
+        return 'Row(%r)' % self.as_dict()
@@ -0,0 +1,117 @@
+'''
+Instrumentation of Doqapy databases.
+
+A listener is a callable added to a database with add_listener(). It is
+called with an event dictionary after each instrumented operation. All
+events have a "type" item and a "time" item containing the duration of
+the operation in seconds. Event types are:
+  query: a query executed with execute() or execute_columns(). Other
+         items are "query" (the query text), "sql", "cache_hit" (True if
+         the compiled query was found in the cache), "parse_time" and
+         "compile_time" (0 on cache hits), "execute_time" (time of the
+         first SQLite step), "fetch_time" (time spent in SQLite to read
+         the following rows), "decode_time" (time spent converting SQL
+         values to Python values) and "rows" (number of rows read). For
+         execute(), the event is emitted when the result is closed (i.e.
+         when all rows have been read or when close() is called). Row
+         values are decoded on first access, out of the measured
+         time, unless values_only or resolve_refs is used. For
+         execute_columns(), decode time is included in fetch time.
+  store: documents stored. The "documents" item contains their number.
+  commit: a transaction commit.
+When a database has no listener, the cost of instrumentation is a test
+per operation.
+'''
+
+import heapq
+import random
+import threading
+import time
+
+# Clock used for durations
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Stats(object):
+    '''Listener aggregating events. For each event type, it counts the
+    events and keeps a sample of at most max_samples durations (chosen
+    by reservoir sampling) used to compute percentiles. The
+    max_slow_queries slowest queries whose duration is at least
+    slow_query_time are also kept.
+    '''
+    def __init__(self, slow_query_time=0.1, max_slow_queries=100, max_samples=100000):
+        self.slow_query_time = slow_query_time
+        self.max_slow_queries = max_slow_queries
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.counts = {}
+            self.totals = {}
+            self.maxima = {}
+            self.rows = 0
+            self.cache_hits = 0
+            self._samples = {}
+            self._slow_queries = []
+
+    def __call__(self, event):
+        event_type = event['type']
+        duration = event['time']
+        with self._lock:
+            count = self.counts.get(event_type, 0) + 1
+            self.counts[event_type] = count
+            self.totals[event_type] = self.totals.get(event_type, 0) + duration
+            self.maxima[event_type] = max(self.maxima.get(event_type, 0), duration)
+            samples = self._samples.setdefault(event_type, [])
+            if len(samples) < self.max_samples:
+                samples.append(duration)
+            else:
+                i = random.randrange(count)
+                if i < self.max_samples:
+                    samples[i] = duration
+            if event_type == 'query':
+                self.rows += event['rows']
+                if event['cache_hit']:
+                    self.cache_hits += 1
+                if duration >= self.slow_query_time:
+                    item = (duration, event['query'], event['sql'])
+                    if len(self._slow_queries) < self.max_slow_queries:
+                        heapq.heappush(self._slow_queries, item)
+                    else:
+                        heapq.heappushpop(self._slow_queries, item)
+
+    def percentile(self, event_type, percent):
+        '''Return the duration below which percent % of the events of the
+        given type fall (None if there is no event).
+        '''
+        with self._lock:
+            samples = sorted(self._samples.get(event_type, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def slow_queries(self):
+        '''Return the list of (duration, query, sql) of the slowest
+        queries sorted by decreasing duration.
+        '''
+        with self._lock:
+            return sorted(self._slow_queries, reverse=True)
+
+    def summary(self):
+        '''Return a dictionary whose keys are event types and values are
+        dictionaries with the number of events ("count"), the total,
+        50th percentile, 99th percentile and maximum durations ("total",
+        "p50", "p99" and "max").
+        '''
+        result = {}
+        for event_type in list(self.counts):
+            result[event_type] = {
+                'count': self.counts[event_type],
+                'total': self.totals[event_type],
+                'p50': self.percentile(event_type, 50),
+                'p99': self.percentile(event_type, 99),
+                'max': self.maxima[event_type],
+            }
+        return result
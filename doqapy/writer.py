@@ -0,0 +1,141 @@
+'''
+Background writer grouping the modifications of concurrent producers
+in large transactions.
+'''
+
+import threading
+import time
+from concurrent.futures import Future
+
+import six
+
+# Queue item asking the writer thread to commit pending documents
+_flush = object()
+# Queue item asking the writer thread to stop
+_stop = object()
+
+
+class DoqapyWriter(object):
+    '''
+    Store documents in a DoqapyDatabase from a single background thread.
+    Producers call store_document() (from any thread) that does not
+    access the database and returns a Future. The writer thread stores
+    pending documents with a single transaction (group commit) as soon
+    as max_batch documents are pending or max_delay seconds after the
+    first pending document had been submitted. Futures are resolved with
+    the documents references once the transaction is committed. If the
+    transaction fails, it is rolled back and its documents are stored
+    again one by one (each in its own transaction) so that the
+    exception is only set on the futures of the documents that cannot
+    be stored. Parameters are:
+      db: the DoqapyDatabase to write to. Other threads must not modify
+          it while the writer is running.
+      max_batch: maximum number of documents in a transaction.
+      max_delay: maximum time (in seconds) a document waits for its
+                 transaction.
+      max_pending: if not 0, store_document() blocks when this number of
+                   documents are waiting for the writer thread.
+    '''
+    def __init__(self, db, max_batch=10000, max_delay=0.1, max_pending=0):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = six.moves.queue.Queue(max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='DoqapyWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def store_document(self, document, collection=None, id=None):
+        '''Submit a document to store. Collection and identifier are
+        chosen as in DoqapyDatabase.store_document(). Return a Future
+        whose result is the reference of the document. This reference is
+        also available in the "ref" attribute of the Future before the
+        document is stored. The document must not be modified until the
+        Future is done.
+        '''
+        if self._closed:
+            raise ValueError('Cannot store documents with a closed writer')
+        collection, id = self.db._document_location(document, collection, id)
+        future = Future()
+        future.ref = '%s/%s' % (collection, id)
+        self._queue.put((future, (document, collection, id)))
+        return future
+
+    def store_documents(self, documents, collection=None):
+        '''Submit several documents and return the list of their Future.'''
+        return [self.store_document(document, collection) for document in documents]
+
+    def flush(self):
+        '''Commit all the documents submitted before the call and wait
+        until it is done.
+        '''
+        if self._closed:
+            raise ValueError('Cannot flush a closed writer')
+        future = Future()
+        self._queue.put((future, _flush))
+        future.result()
+
+    def close(self):
+        '''Store pending documents and stop the writer thread.'''
+        if not self._closed:
+            self._closed = True
+            self._queue.put((None, _stop))
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        running = True
+        while running:
+            # Wait for the first document of a transaction
+            future, item = self._queue.get()
+            pending = []
+            waiters = []
+            deadline = time.time() + self.max_delay
+            while True:
+                if item is _stop:
+                    running = False
+                    break
+                elif item is _flush:
+                    waiters.append(future)
+                    break
+                pending.append((future, item))
+                if len(pending) >= self.max_batch:
+                    break
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    future, item = self._queue.get(timeout=timeout)
+                except six.moves.queue.Empty:
+                    break
+            if pending:
+                self._write(pending)
+            for future in waiters:
+                future.set_result(None)
+
+    def _write(self, pending):
+        futures = [i[0] for i in pending]
+        try:
+            refs = self.db._store_located([i[1] for i in pending])
+            self.db.commit()
+        except Exception as e:
+            try:
+                self.db.rollback()
+            except Exception:
+                pass
+            if len(pending) == 1:
+                futures[0].set_exception(e)
+            else:
+                # Do not let an invalid document make the documents of
+                # other producers fail.
+                for item in pending:
+                    self._write([item])
+        else:
+            for future, ref in zip(futures, refs):
+                future.set_result(ref)
@@ -31,6 +31,7 @@ setup(
     zip_safe=False,
     extras_require={
         'yaml_io': ['yaml'],
+        'numpy': ['numpy'],
     },
     install_requires=requires,
 )
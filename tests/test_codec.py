@@ -0,0 +1,24 @@
+import datetime
+import unittest
+
+from doqapy.codec import decode_list, decode_text_list, encode_list
+
+
+class TestListCodec(unittest.TestCase):
+    def test_json_lists(self):
+        for value in ([], [1, 2], ['a', 'b\tc'], [True, None, 1.5]):
+            self.assertEqual(decode_list(encode_list(value)), value)
+
+    def test_legacy_lists(self):
+        self.assertEqual(decode_list("'a'\t'b'"), ['a', 'b'])
+        self.assertEqual(decode_list('1\t2'), [1, 2])
+        self.assertEqual(decode_text_list('2020-01-01\t2020-01-02'), ['2020-01-01', '2020-01-02'])
+
+    def test_legacy_empty_lists(self):
+        # Legacy format stored empty lists as empty strings
+        self.assertEqual(decode_list(''), [])
+        self.assertEqual(decode_text_list(''), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import doqapy
+
+
+class SqliteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def connect(self, options=''):
+        return doqapy.connect('sqlite:%s%s' % (self.path, options))
+
+
+class TestQueryCache(SqliteTestCase):
+    def test_hits(self):
+        db = self.connect()
+        db.store_document({'n': 1}, 'c')
+        for i in range(3):
+            list(db.execute('select c.n'))
+        info = db.query_cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+        # A schema modification invalidates compiled queries
+        db.store_document({'n': 2, 'x': 'x'}, 'c')
+        self.assertEqual(len(list(db.execute('select c.n'))), 2)
+        info = db.query_cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 2))
+
+    def test_rollback(self):
+        db = self.connect()
+        db.store_document({'n': 1}, 'c')
+        db.commit()
+        db.store_document({'n': 2}, 'c')
+        db.store_document({'n': 3, 'x': 'x'}, 'c')
+        self.assertEqual([row['c.n'] for row in db.execute('select c')], [1, 2, 3])
+        db.rollback()
+        # The schema version restored by the rollback is reused
+        db.store_document({'n': 4}, 'c')
+        db.store_document({'n': 5, 'y': 5}, 'c')
+        rows = [row.as_dict() for row in db.execute('select c')]
+        self.assertEqual([(row['c.n'], row.get('c.y')) for row in rows], [(1, None), (4, None), (5, 5)])
+        self.assertNotIn('c.x', rows[0])
+
+
+class TestUpgradeStorage(SqliteTestCase):
+    def legacy_database(self, **fields):
+        '''Return a database with a "c" collection whose list fields
+        contain the given values stored in the legacy list format.
+        '''
+        db = self.connect()
+        count = len(next(iter(fields.values())))
+        db.store_documents((dict((field, ['x']) for field in sorted(fields)) for i in range(count)),
+                           collection='c')
+        for field, values in fields.items():
+            db._cnx.executemany('UPDATE c SET %s = ? WHERE rowid = ?' % field,
+                                [(value, i + 1) for i, value in enumerate(values)])
+        db._cnx.execute('PRAGMA user_version = 0')
+        db.commit()
+        return self.connect()
+
+    def test_legacy_lists(self):
+        db = self.legacy_database(tags=["'a'\t'b'", ''])
+        self.assertEqual([d['tags'] for d in db.documents('c')], [['a', 'b'], []])
+        db.upgrade_storage()
+        self.assertEqual(db.storage_version, 3)
+        self.assertEqual([r[0] for r in db._cnx.execute('SELECT tags FROM c')], ['["a","b"]', '[]'])
+        self.assertEqual(list(db.execute('select c.tags where "a" in c.tags', values_only=True)), [(['a', 'b'],)])
+
+    def test_list_tables_require_upgrade(self):
+        db = self.legacy_database(tags=["'a'\t'b'"])
+        self.assertRaises(ValueError, db.execute, 'select c.tags where "a" in c.tags')
+        self.assertRaises(ValueError, db.distinct, 'c.tags')
+        # Other queries on list fields do not need list tables
+        self.assertEqual(list(db.execute('select c.tags', values_only=True)), [(['a', 'b'],)])
+        db.upgrade_storage()
+        self.assertEqual(len(list(db.execute('select c.tags where "a" in c.tags'))), 1)
+        self.assertEqual(sorted(db.distinct('c.tags')), ['a', 'b'])
+
+    def test_failed_upgrade_is_rolled_back(self):
+        # "a" is converted before the error on "b"
+        db = self.legacy_database(a=["'a'", "'b'"], b=["'a'", 'invalid('])
+        self.assertRaises(SyntaxError, db.upgrade_storage)
+        self.assertEqual(db.storage_version, 0)
+        self.assertFalse(db._cnx.in_transaction)
+        self.assertEqual([r[0] for r in db._cnx.execute('SELECT a FROM c')], ["'a'", "'b'"])
+
+
+class TestBulkLoad(SqliteTestCase):
+    def index_names(self, db):
+        return set(row[0] for row in db._cnx.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+
+    def test_bulk_load(self):
+        db = self.connect()
+        with db.bulk_load():
+            db.store_documents(({'n': n} for n in range(100)), collection='c')
+            db.get_collection('c').create_index('n')
+            self.assertNotIn('_c_n', self.index_names(db))
+            self.assertIn('n', db.indices('c'))
+        self.assertIn('_c_n', self.index_names(db))
+        self.assertEqual(db._cnx.execute('SELECT count(*) FROM _pending_indices').fetchone()[0], 0)
+        self.assertEqual(len(list(self.connect().execute('select c.n'))), 100)
+
+    def test_interrupted_bulk_load(self):
+        db = self.connect()
+        db.store_documents(({'n': n} for n in range(10)), collection='c')
+        db.get_collection('c').create_index('n')
+        db.commit()
+        try:
+            with db.bulk_load(drop_indices=True):
+                db.store_documents(({'n': n} for n in range(10, 20)), collection='c')
+                raise KeyboardInterrupt()
+        except KeyboardInterrupt:
+            pass
+        self.assertFalse(db._cnx.in_transaction)
+        self.assertEqual(len(list(db.execute('select c.n'))), 10)
+        # Dropped indices are still reported and can be built from
+        # another connection.
+        self.assertNotIn('_c_n', self.index_names(db))
+        self.assertIn('n', db.indices('c'))
+        other = self.connect()
+        other.build_pending_indices()
+        self.assertIn('_c_n', self.index_names(other))
+        self.assertEqual(other._cnx.execute('SELECT count(*) FROM _pending_indices').fetchone()[0], 0)
+
+
+class TestKeysetPagination(SqliteTestCase):
+    def setUp(self):
+        super(TestKeysetPagination, self).setUp()
+        self.db = self.connect()
+        self.db.store_documents(({'n': n} for n in range(100)), collection='c')
+        self.db.commit()
+
+    def pages(self, query, params=None):
+        '''Return the values of the two first pages of a query.'''
+        result = self.db.execute(query, params, values_only=True)
+        first = [row[0] for row in result]
+        result = self.db.execute(query, params, values_only=True, after=result.continuation())
+        return first, [row[0] for row in result]
+
+    def test_limit(self):
+        self.assertEqual(self.pages('select c.n where c.n >= 0 order by c.n limit 10'),
+                         (list(range(10)), list(range(10, 20))))
+        self.assertEqual(self.pages('select c.n order by c.n desc limit ?', [3]),
+                         ([99, 98, 97], [96, 95, 94]))
+
+    def test_offset(self):
+        self.assertEqual(self.pages('select c.n where c.n >= 0 order by c.n limit 10 offset 20'),
+                         (list(range(20, 30)), list(range(30, 40))))
+        self.db.store_documents(({'n': n} for n in (1, 5, 9, 13, 17)), collection='d')
+        self.assertEqual(self.pages('select d.n where d.n > ? order by d.n limit ? offset ?', [0, 2, 1]),
+                         ([5, 9], [13, 17]))
+
+
+class TestConnectionPool(SqliteTestCase):
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        db = self.connect()
+        db.store_documents(({'n': n} for n in range(10)), collection='c')
+        db.commit()
+
+    def test_pool_implies_wal(self):
+        db = self.connect('?pool=2')
+        self.assertTrue(db.wal)
+        self.assertEqual(db._cnx.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        # An open result does not prevent the writer to commit
+        result = db.execute('select c.n')
+        self.assertEqual(len(result.fetchmany(2)), 2)
+        db.store_document({'n': 10}, 'c')
+        db.commit()
+        self.assertEqual(len(list(result)), 8)
+
+    def test_plain_connection_with_pool(self):
+        db = self.connect('?pool=2')
+        result = db.execute('select c.n')
+        self.assertEqual(len(result.fetchmany(2)), 2)
+        # A connection without pool or wal keeps the WAL mode
+        writer = self.connect()
+        self.assertTrue(writer.wal)
+        writer.store_documents(({'n': n} for n in range(10, 20)), collection='c')
+        writer.commit()
+        self.assertEqual(db._cnx.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(len(list(result)), 8)
+        self.assertEqual(len(list(db.execute('select c.n'))), 20)
+
+    def test_nested_queries(self):
+        db = self.connect('?pool=1')
+        counts = [list(db.execute('select count(c) where c.n < ?', [row['c.n']], values_only=True))[0][0]
+                  for row in db.execute('select c.n order by c.n')]
+        self.assertEqual(counts, list(range(10)))
+        self.assertEqual(db._pool._idle.qsize(), 1)
+
+    def test_threads(self):
+        db = self.connect('?pool=2')
+        results = []
+
+        def read():
+            for i in range(20):
+                results.append(len(list(db.execute('select c.n'))))
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [10] * 80)
+        self.assertEqual(db._pool._held, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import doqapy
+
+
+class TestWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = doqapy.connect('sqlite:%s' % os.path.join(self.directory, 'test.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def values(self):
+        return sorted(row[0] for row in self.db.execute('select c.n', values_only=True))
+
+    def test_producers(self):
+        futures = []
+        with self.db.writer(max_batch=100, max_delay=0.01) as writer:
+            def produce(first):
+                futures.extend(writer.store_documents(({'n': n} for n in range(first, first + 500)), 'c'))
+            threads = [threading.Thread(target=produce, args=(i * 500,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(futures), 2000)
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(set(future.result() for future in futures), set(future.ref for future in futures))
+        self.assertEqual(self.values(), list(range(2000)))
+
+    def test_flush_and_close(self):
+        writer = self.db.writer(max_delay=60)
+        future = writer.store_document({'n': 1}, 'c')
+        writer.flush()
+        self.assertEqual(future.result(timeout=0), future.ref)
+        self.assertEqual(self.values(), [1])
+        future = writer.store_document({'n': 2}, 'c')
+        writer.close()
+        self.assertTrue(future.done())
+        self.assertEqual(self.values(), [1, 2])
+        self.assertRaises(ValueError, writer.store_document, {'n': 3}, 'c')
+        self.assertRaises(ValueError, writer.flush)
+        writer.close()
+
+    def test_failing_document(self):
+        with self.db.writer(max_delay=60) as writer:
+            first = writer.store_document({'n': 1}, 'c')
+            invalid = writer.store_document({'n': 2, 'k': []}, 'c')
+            last = writer.store_document({'n': 3}, 'c')
+            writer.flush()
+        self.assertEqual(first.result(timeout=0), first.ref)
+        self.assertEqual(last.result(timeout=0), last.ref)
+        self.assertIsNotNone(invalid.exception(timeout=0))
+        self.assertEqual(self.values(), [1, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()